@@ -47,12 +47,12 @@ def save(cm: cityjson.CityJSON, path: Path, indent=False):
     We need this function because cjio.cityjson.save() is deprecated with v0.8.0.
     """
     try:
-        with path.open("w") as fout:
-            if indent:
-                json_str = json.dumps(cm.j, indent="\t")
-            else:
-                json_str = json.dumps(cm.j, separators=(',',':'))
-            fout.write(json_str)
+        if indent:
+            with path.open("w") as fout:
+                fout.write(json.dumps(cm.j, indent="\t"))
+        else:
+            with path.open("wb") as fout:
+                fout.write(utils.json_dumps(cm.j))
     except IOError as e:
         raise IOError('Invalid output file: %s \n%s' % (path, e))
 
@@ -94,25 +94,19 @@ def export_all_cmd(ctx, filename):
     path = Path(filename).resolve()
     if not Path(path.parent).exists():
         raise NotADirectoryError(f"Directory {path.parent} not exists")
-    conn = db.Db(**ctx.obj['cfg']['database'])
-    if not conn.create_functions():
-        raise click.exceptions.ClickException(
-            "Could not create the required functions in PostgreSQL, "
-            "check the logs for details")
     try:
         click.echo(f"Exporting the whole database")
         dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
                                 tile_index=ctx.obj['cfg']['tile_index'],
                                 cityobject_type=ctx.obj['cfg'][
-                                    'cityobject_type'], threads=1)
+                                    'cityobject_type'], threads=1,
+                                stream=True)
         cm = db3dnl.convert(dbexport, cfg=ctx.obj['cfg'])
         cm.j["metadata"]["fileIdentifier"] = path.name
         save(cm, path=path, indent=False)
         click.echo(f"Saved CityJSON to {path}")
     except Exception as e:
         raise click.exceptions.ClickException(e)
-    finally:
-        conn.close()
 
 @click.command('export_tiles')
 @click.option('--merge', is_flag=True,
@@ -122,10 +116,13 @@ def export_all_cmd(ctx, filename):
 @click.option('--jobs', '-j', type=int, default=1,
               help='The number of parallel jobs to run')
 @click.option("--features", is_flag=True, help="Export CityJSONFeatures.")
+@click.option("--jsonl", is_flag=True,
+              help="With --features, write the features of a tile into a "
+                   "single JSON Lines file instead of a file per feature.")
 @click.argument('tiles', nargs=-1, type=str)
 @click.argument('dir', type=str)
 @click.pass_context
-def export_tiles_cmd(ctx, tiles, merge, zip, jobs, features, dir):
+def export_tiles_cmd(ctx, tiles, merge, zip, jobs, features, jsonl, dir):
     """Export the objects within the given tiles into a CityJSON file.
 
     TILES is a list of tile IDs from the tile_index, or 'all' which exports
@@ -135,13 +132,25 @@ def export_tiles_cmd(ctx, tiles, merge, zip, jobs, features, dir):
 
     When exporting to CityJSONFeatures, a directory tree is created from the tile IDs,
     and each tile directory contains the features in that tile. Each feature is written
-    to a separate file.
+    to a separate file. With --jsonl, the features of a tile are written into a
+    single JSON Lines file instead, one feature per line.
     At the root of the directory tree the 'metadata.city.json' file is written, which
     contains the CRS and transformation properties for all the features.
+
+    With --merge, --jobs sets the number of threads that query the cityobject
+    tables in parallel.
     """
+    if jsonl and not features:
+        raise click.UsageError(
+            "--jsonl can only be used together with --features.")
     path = Path(dir).resolve()
     path.mkdir(parents=True, exist_ok=True)
-    tile_list = db3dnl.get_tile_list(ctx.obj["cfg"], tiles)
+    if merge and db3dnl.is_all_tiles(tiles):
+        # The merged export selects all the tiles in its query, no need to list
+        # them
+        tile_list = db3dnl.ALL_TILES
+    else:
+        tile_list = db3dnl.get_tile_list(ctx.obj["cfg"], tiles)
 
     if merge:
         filepath = (path / 'merged').with_suffix('.json')
@@ -150,7 +159,7 @@ def export_tiles_cmd(ctx, tiles, merge, zip, jobs, features, dir):
             dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
                                     tile_index=ctx.obj['cfg']['tile_index'],
                                     cityobject_type=ctx.obj['cfg'][
-                                        'cityobject_type'], threads=1,
+                                        'cityobject_type'], threads=jobs,
                                     tile_list=tile_list)
             cm = db3dnl.convert(dbexport, cfg=ctx.obj['cfg'])
             cm.j["metadata"]["fileIdentifier"] = filepath.name
@@ -163,7 +172,8 @@ def export_tiles_cmd(ctx, tiles, merge, zip, jobs, features, dir):
         click.echo(f"Exporting {len(tile_list)} tiles...")
         click.echo(f"Output directory: {path}")
         db3dnl.export_tiles_multiprocess(ctx.obj['cfg'], jobs, path, tile_list,
-                                         zip=zip, features=features)
+                                         zip=zip, features=features,
+                                         jsonl=jsonl)
         return 0
 
 
@@ -182,23 +192,19 @@ def export_bbox_cmd(ctx, bbox, filename):
     path = Path(filename).resolve()
     if not Path(path.parent).exists():
         raise NotADirectoryError(f"Directory {path.parent} not exists")
-    conn = db.Db(**ctx.obj['cfg']['database'])
-    if not conn.create_functions():
-        raise click.exceptions.ClickException("Could not create the required functions in PostgreSQL, check the logs for details")
     try:
         click.echo(f"Exporting with BBOX={bbox}")
         dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
                                 tile_index=ctx.obj['cfg']['tile_index'],
                                 cityobject_type=ctx.obj['cfg'][
-                                    'cityobject_type'], threads=1, bbox=bbox)
+                                    'cityobject_type'], threads=1, bbox=bbox,
+                                stream=True)
         cm = db3dnl.convert(dbexport, cfg=ctx.obj['cfg'])
         cm.j["metadata"]["fileIdentifier"] = path.name
         save(cm, path=path, indent=False)
         click.echo(f"Saved CityJSON to {path}")
     except Exception as e:
         raise click.exceptions.ClickException(e)
-    finally:
-        conn.close()
 
 
 @click.command('export_extent')
@@ -218,23 +224,19 @@ def export_extent_cmd(ctx, extent, filename):
         raise NotADirectoryError(f"Directory {path.parent} not exists")
 
     polygon = cjio_dbexport.utils.read_geojson_polygon(extent)
-    conn = db.Db(**ctx.obj['cfg']['database'])
-    if not conn.create_functions():
-        raise click.exceptions.ClickException("Could not create the required functions in PostgreSQL, check the logs for details")
     try:
         click.echo(f"Exporting with polygonal selection. Polygon={extent.name}")
         dbexport = db3dnl.query(conn_cfg=ctx.obj['cfg']['database'],
                                 tile_index=ctx.obj['cfg']['tile_index'],
                                 cityobject_type=ctx.obj['cfg'][
-                                    'cityobject_type'], threads=1, extent=polygon)
+                                    'cityobject_type'], threads=1,
+                                extent=polygon, stream=True)
         cm = db3dnl.convert(dbexport, cfg=ctx.obj['cfg'])
         cm.j["metadata"]["fileIdentifier"] = path.name
         save(cm, path=path, indent=False)
         click.echo(f"Saved CityJSON to {path}")
     except Exception as e:
         raise click.exceptions.ClickException(e)
-    finally:
-        conn.close()
 
 
 @click.command('index')
@@ -242,10 +244,18 @@ def export_extent_cmd(ctx, extent, filename):
               help="Drop the tile_index.table if it exists.")
 @click.option('--centroid', is_flag=True,
               help="Create a spatial index on the input geometry centroids.")
+@click.option('--method', type=click.Choice(list(db3dnl.INDEX_METHODS)),
+              default='gist', show_default=True,
+              help="The index method for --centroid. Use 'brin' only if the "
+                   "input tables are spatially clustered.")
+@click.option('--cluster', is_flag=True,
+              help="Cluster the input tables on the GiST index of their "
+                   "geometry centroids, which is created if needed. Rewrites "
+                   "the tables.")
 @click.argument('extent', type=click.File('r'))
 @click.argument('tilesize', type=float, nargs=2)
 @click.pass_context
-def index_cmd(ctx, extent, tilesize, drop, centroid):
+def index_cmd(ctx, extent, tilesize, drop, centroid, method, cluster):
     """Create a tile index for the specified extent.
 
     Run this command to create rectangular tiles for EXTENT and store the
@@ -366,11 +376,22 @@ def index_cmd(ctx, extent, tilesize, drop, centroid):
                 f"Check the logs for details.")
         if centroid:
             click.echo("Indexing input geometry centroids")
-            good = db3dnl.index_geometry_centroid(conn, ctx.obj['cfg'])
+            good = db3dnl.index_geometry_centroid(conn, ctx.obj['cfg'],
+                                                  method=method)
         if not good:
             raise click.ClickException(
-                f"Could not GiST on feature geometry centroids."
-                f"Check the logs for details.")
+                f"Could not create {method} index on feature geometry "
+                f"centroids. Check the logs for details.")
+        if cluster:
+            click.echo("Clustering input tables on the geometry centroids")
+            good = db3dnl.index_geometry_centroid(conn, ctx.obj['cfg'],
+                                                  method="gist")
+            if good:
+                good = db3dnl.cluster_geometry_centroid(conn, ctx.obj['cfg'])
+            if not good:
+                raise click.ClickException(
+                    f"Could not cluster the input tables on the geometry "
+                    f"centroids. Check the logs for details.")
 
     finally:
         conn.close()
@@ -25,7 +25,8 @@ SOFTWARE.
 """
 import logging
 import re
-from typing import List, Tuple
+from typing import List, Tuple, Iterator
+from uuid import uuid4
 from collections import abc
 from keyword import iskeyword
 
@@ -60,6 +61,7 @@ class Db(object):
                 raise
         else:
             self.conn = conn
+        self._fields = {}
 
     def send_query(self, query: psycopg2.sql.Composable):
         """Send a query to the DB when no results need to return (e.g. CREATE).
@@ -75,13 +77,52 @@ class Db(object):
                 cur.execute(query)
                 return cur.fetchall()
 
-    def get_dict(self, query: psycopg2.sql.Composable) -> dict:
-        """DB query where the results need to return as a dictionary."""
+    def get_query_iter(self, query: psycopg2.sql.Composable,
+                       itersize: int = 10000) -> Iterator[Tuple]:
+        """DB query where the results are streamed from a server-side cursor.
+
+        The rows are fetched from the server in batches of `itersize`, so the
+        whole resultset is never held in memory at once.
+        """
         with self.conn:
-            with self.conn.cursor(
-                cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            with self.conn.cursor(name=f"cjdb_{uuid4().hex}") as cur:
+                cur.itersize = itersize
                 cur.execute(query)
-                return cur.fetchall()
+                yield from cur
+
+    def get_dict(self, query: psycopg2.sql.Composable) -> List[dict]:
+        """DB query where the results need to return as a dictionary.
+
+        The rows are fetched as tuples and zipped with the column names into
+        plain dicts. This is considerably cheaper for large resultsets than a
+        :class:`psycopg2.extras.RealDictCursor`, which sets each column of each
+        row with a Python-level method call.
+        """
+        with self.conn:
+            with self.conn.cursor() as cur:
+                cur.execute(query)
+                columns = [desc[0] for desc in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def get_dict_iter(self, query: psycopg2.sql.Composable,
+                      itersize: int = 10000) -> Iterator[dict]:
+        """DB query where the results are streamed as dictionaries from a
+        server-side cursor, see :meth:`get_query_iter`.
+        """
+        with self.conn:
+            with self.conn.cursor(name=f"cjdb_{uuid4().hex}") as cur:
+                cur.itersize = itersize
+                cur.execute(query)
+                # The description of a named cursor is only available after the
+                # first batch of rows was fetched
+                rows = iter(cur)
+                first = next(rows, None)
+                if first is None:
+                    return
+                columns = [desc[0] for desc in cur.description]
+                yield dict(zip(columns, first))
+                for row in rows:
+                    yield dict(zip(columns, row))
 
     def print_query(self, query: psycopg2.sql.Composable) -> str:
         """Format a SQL query for printing by replacing newlines and tab-spaces.
@@ -123,12 +164,20 @@ class Db(object):
         return version
 
     def get_fields(self, table):
-        """List the fields in a table."""
-        query = sql.SQL("SELECT * FROM {table} LIMIT 0;").format(table=table)
-        with self.conn:
-            with self.conn.cursor() as cur:
-                cur.execute(query)
-                return [desc[0] for desc in cur.description]
+        """List the fields in a table.
+
+        The fields are cached per table for the lifetime of the object, because
+        they are requested for each query that is built on the table.
+        """
+        key = table.as_string(self.conn)
+        if key not in self._fields:
+            query = sql.SQL("SELECT * FROM {table} LIMIT 0;").format(
+                table=table)
+            with self.conn:
+                with self.conn.cursor() as cur:
+                    cur.execute(query)
+                    self._fields[key] = [desc[0] for desc in cur.description]
+        return list(self._fields[key])
 
     def close(self):
         """Close connection."""
@@ -246,6 +295,20 @@ def literal(relation_name):
     return property(lit_getter, lit_setter)
 
 
+def array_literal(values) -> sql.Literal:
+    """Return an untyped PostgreSQL array literal, eg. ``'{"gb1","gb2"}'``.
+
+    Unlike a :class:`psycopg2.sql.Literal` of a list, which is adapted to a
+    typed ``ARRAY[...]`` constructor, the untyped literal takes the type of the
+    column that it is compared to, so it works for text and integer keys alike.
+    """
+    elements = (
+        '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for value in values
+    )
+    return sql.Literal("{" + ",".join(elements) + "}")
+
+
 class DbRelation:
     """Database relation name.
 
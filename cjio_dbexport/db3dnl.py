@@ -23,15 +23,21 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import itertools
 import logging
-import re
+import os
+import queue
+import struct
+import threading
 from concurrent.futures.process import ProcessPoolExecutor
-from datetime import date, time, datetime, timedelta
-from typing import Mapping, Sequence, Tuple, List
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import json
+from multiprocessing.util import Finalize
+from datetime import date, time, timedelta
+from typing import Mapping, Sequence, Tuple, List, Optional, Iterable
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial, lru_cache
 from pathlib import Path
 
+import numpy as np
 from click import ClickException
 from cjio import cityjson
 from cjio.models import CityObject, Geometry
@@ -44,21 +50,70 @@ log = logging.getLogger(__name__)
 # Zwaartepunt bij Putten, https://nl.wikipedia.org/wiki/Geografisch_middelpunt_van_Nederland
 TRANSLATE = [171800.0, 472700.0, 0.0]
 IMPORTANT_DIGITS = 4
+# Scale of the transform, eg. 0.0001 for 4 important digits
+SCALE = float(f"1e-{IMPORTANT_DIGITS}")
+# The 'first' CityJSON file of a CityJSONFeature export, containing the CRS and
+# transform properties. It is the same for every export, so it is built once.
+CITYJSON_METADATA = utils.json_dumps({
+    "type": "CityJSON",
+    "version": "1.1",
+    "CityObjects": {},
+    "vertices": [],
+    "transform": {"scale": [SCALE, SCALE, SCALE], "translate": TRANSLATE},
+    "metadata": {
+        "referenceSystem": "https://www.opengis.net/def/crs/EPSG/0/7415"
+    }
+})
+# Nr. of resultsets that the threaded query() holds in memory at once, from the
+# start of their fetch until the consumer is done with them
+QUEUE_SIZE = 2
+# Nr. of records that are fetched at a time when query() streams a table. The
+# records carry the geometry, so the batches are smaller than for plain rows.
+STREAM_ITERSIZE = 2000
+# WKT geometry type prefix that is parsed by parse_polygonz()
+POLYGONZ_PREFIX = "POLYGON Z"
+# Rings with fewer vertices are parsed in pure Python, see parse_polygonz
+WKT_NUMPY_MIN_POINTS = 16
+# Geometries with fewer surfaces are labelled in pure Python, see
+# record_to_surfaces
+SEMANTICS_NUMPY_MIN_SURFACES = 64
+# WKB geometry type codes that are parsed by parse_wkb_multisurface()
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+WKB_POLYHEDRALSURFACE = 15
+WKB_TIN = 16
+WKB_TRIANGLE = 17
+# Write buffer for the CityJSONFeatures of a tile in a JSON Lines file
+JSONL_BUFFER_SIZE = 1024 * 1024
+# Nr. of threads that write the CityJSONFeatures of a tile into separate files
+FEATURE_WRITERS = 4
+# Selects all the tiles of the tile index, without listing their IDs
+ALL_TILES = ("all",)
+# Memory for building the spatial indexes, set for the index transaction only
+MAINTENANCE_WORK_MEM = "1GB"
+# Index methods for the geometry centroids, with their storage parameters
+INDEX_METHODS = {
+    "gist": "",
+    "spgist": "",
+    "brin": "WITH (pages_per_range = 32)",
+}
+# The configuration and connection pool in a worker process of
+# export_tiles_multiprocess()
+_worker_cfg = None
+_worker_pool = None
+_worker_db = None
 
 
 def get_tile_list(cfg: Mapping, tiles: List) -> List:
     conn = db.Db(**cfg['database'])
-    if not conn.create_functions():
-        raise BaseException(
-            "Could not create the required functions in PostgreSQL, check the logs for details")
     tile_index = db.Schema(cfg['tile_index'])
     try:
         tile_list = with_list(conn=conn, tile_index=tile_index,
                               tile_list=tiles)
         log.info(f"Found {len(tile_list)} tiles in the tile index.")
 
-    except BaseException as e:
-        raise BaseException(
+    except Exception as e:
+        raise Exception(
             f"Could not generate tile_list. Check the logs for details.\n{e}")
     finally:
         conn.close()
@@ -67,9 +122,9 @@ def get_tile_list(cfg: Mapping, tiles: List) -> List:
 
 def export_tiles_multiprocess(cfg: Mapping, jobs: int, path: Path, tile_list: List,
                               zip: bool = False, prefix_file: str = None,
-                              features: bool = False) -> Mapping:
+                              features: bool = False,
+                              jsonl: bool = False) -> Mapping:
     failed = []
-    futures = []
     if prefix_file is None:
         prefix_file = ""
     if not path.exists():
@@ -78,174 +133,343 @@ def export_tiles_multiprocess(cfg: Mapping, jobs: int, path: Path, tile_list: Li
         # because we have 1 JSON object per file, such as each CityJSONFeature is in
         # a separate file
         suffix = ".city.json"
-        # The 'first' CityJSON file, containing the CRS and transform properties
-        cityjson_meta = {}
-        cityjson_meta["type"] = "CityJSON"
-        cityjson_meta["version"] = "1.1"
-        cityjson_meta["CityObjects"] = {}
-        cityjson_meta["vertices"] = []
-        # set scale
-        ss = '0.'
-        ss += '0' * (IMPORTANT_DIGITS - 1)
-        ss += '1'
-        ss = float(ss)
-        cityjson_meta["transform"] = {"scale": [ss, ss, ss], "translate": TRANSLATE}
-        cityjson_meta["metadata"] = {
-            "referenceSystem": "https://www.opengis.net/def/crs/EPSG/0/7415"
-        }
-        json.dumps(cityjson_meta, separators=(',', ':'))
-        # we write it to the root of the directory tree
+        # The 'first' CityJSON file, containing the CRS and transform
+        # properties, we write it to the root of the directory tree
         filepath = (path / "metadata").with_suffix(suffix)
         try:
-            json_str = json.dumps(cityjson_meta, separators=(',', ':'))
             if zip:
-                filepath = utils.write_zip(data=json_str.encode("utf-8"),
+                filepath = utils.write_zip(data=CITYJSON_METADATA,
                                            filename=filepath.name,
                                            outdir=filepath.parent)
             else:
-                with open(filepath, "w") as fout:
-                    fout.write(json_str)
+                with open(filepath, "wb") as fout:
+                    fout.write(CITYJSON_METADATA)
             log.info(f"Written CityJSON metadata file to {filepath}")
         except IOError as e:
             log.error(f"Invalid output file: {filepath}\n{e}")
             # exit early
             return {"exported": len(tile_list), "nr_failed:": len(failed),
                     "failed": "all"}
-        except BaseException as e:
+        except Exception as e:
             log.exception(e)
             # exit early
             return {"exported": len(tile_list), "nr_failed:": len(failed),
                     "failed": "all"}
     else:
         suffix = ".city.json"
-    with ProcessPoolExecutor(max_workers=jobs) as executor:
+    if jobs > 1 and len(tile_list) > jobs:
+        # Start with the largest tiles, so that a large tile does not keep a
+        # single worker busy at the end of the export
+        conn = db.Db(**cfg["database"])
+        try:
+            tile_list = order_tiles_by_size(conn, cfg, tile_list)
+        finally:
+            conn.close()
+    # The results are processed in a callback as soon as a tile is done, so
+    # that the executor does not need to keep the finished futures around
+    counter = itertools.count(1)
+    lock = threading.Lock()
+    total = len(tile_list)
+    # The configuration is handed to each worker process once, instead of being
+    # pickled with each tile
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(cfg,)) as executor:
         for tile in tile_list:
             filepath = (path / f"{prefix_file}{tile}").with_suffix((suffix))
-            futures.append(executor.submit(export, tile, filepath,
-                                           cfg, zip, features))
-
-        for i, future in enumerate(as_completed(futures)):
-            success, filepath = future.result()
-            if success:
-                if features:
-                    log.info(
-                        f"[{i + 1}/{len(tile_list)}] Saved all features from tile {filepath}")
-                else:
-                    log.info(
-                        f"[{i + 1}/{len(tile_list)}] Saved {filepath.name}")
+            future = executor.submit(_export_in_worker, tile, filepath, zip,
+                                     features, jsonl)
+            future.add_done_callback(
+                partial(_log_and_free, filepath=filepath, counter=counter,
+                        lock=lock, total=total, failed=failed,
+                        features=features))
+            del future
+    log.info(
+        f"Done. Exported {len(tile_list) - len(failed)} tiles. "
+        f"Failed {len(failed)} tiles: {failed}")
+    return {"exported": len(tile_list) - len(failed),
+            "nr_failed:": len(failed),
+            "failed": failed}
+
+
+def order_tiles_by_size(conn: db.Db, cfg: Mapping, tile_list: List) -> List:
+    """Order the tiles by their estimated number of CityObjects, largest first.
+
+    The number of CityObjects in a tile is estimated from the planner
+    statistics of the geometry column of each cityobject table with PostGIS'
+    ``_postgis_selectivity()``, so that the tables are not scanned. If the
+    statistics are missing, eg. a table has not been analyzed yet, the tile
+    list is returned as it is.
+
+    ``_postgis_selectivity()`` is an internal function of PostGIS, which is
+    not documented and can change between PostGIS versions. If it fails, the
+    tiles are exported in the given order too, because the order only affects
+    how the jobs are balanced between the workers. The number of rows of an
+    unanalyzed table is -1 on PostgreSQL 14+, so it is clamped to 0.
+    """
+    tile_index = db.Schema(cfg["tile_index"])
+    template = sql.SQL(
+        "coalesce(_postgis_selectivity({table}::regclass, {geom_col}, "
+        "i.{tx_geom}) "
+        "* (SELECT greatest(reltuples, 0) FROM pg_class "
+        "WHERE oid = {table}::regclass), 0)"
+    )
+    estimates = []
+    for cotables in cfg["cityobject_type"].values():
+        for cotable in cotables:
+            features = db.Schema(cotable)
+            geom_fields = features.field.geometry
+            lod = next(iter(geom_fields.keys()))
+            estimates.append(template.format(
+                table=sql.Literal(
+                    (features.schema + features.table).as_string(conn.conn)),
+                geom_col=sql.Literal(getattr(geom_fields, lod).name.string),
+                tx_geom=tile_index.field.geometry.sqlid,
+            ))
+    query = sql.SQL(
+        """
+    SELECT i.{tile}::text
+    FROM {tile_index} i
+    {tx_where}
+    ORDER BY {estimate} DESC
+    """
+    ).format(
+        tile=tile_index.field.pk.sqlid,
+        tile_index=tile_index.schema + tile_index.table,
+        tx_where=sql_where_tiles(tile_index, tile_list),
+        estimate=sql.SQL(" + ").join(estimates),
+    )
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(conn.print_query(query))
+    try:
+        ordered = [tile for (tile,) in conn.get_query_iter(query)]
+    except pgError as e:
+        log.info(f"Could not estimate the size of the tiles, exporting them "
+                 f"in the given order.\n{e.pgerror}")
+        return tile_list
+    # Keep any tile that the query did not return, the export reports it
+    ordered_set = set(ordered)
+    ordered.extend(tile for tile in tile_list if str(tile) not in ordered_set)
+    return ordered
+
+
+def _init_worker(cfg: Mapping):
+    """Store the configuration in a worker process of
+    :func:`export_tiles_multiprocess`, and create the connection pool of the
+    worker.
+
+    The worker exports one tile at a time, so the pool holds a single
+    connection, which is reused for all the tiles of the worker instead of
+    connecting to the database for each tile. The pool only keeps the returned
+    connections up to `minconn` open, so `minconn` must be 1.
+    """
+    global _worker_cfg, _worker_pool
+    _worker_cfg = cfg
+    _worker_pool = pool.SimpleConnectionPool(minconn=1, maxconn=1,
+                                             **cfg["database"])
+    # Close the connection when the worker process exits
+    Finalize(_worker_pool, _worker_pool.closeall, exitpriority=10)
+
+
+def _export_in_worker(tile, filepath, zip: bool = False,
+                      features: bool = False, jsonl: bool = False):
+    """Run :func:`export` in a worker process, with the configuration that was
+    stored by :func:`_init_worker` and a connection from the worker's pool."""
+    global _worker_db
+    conn = _worker_pool.getconn()
+    try:
+        if not conn.readonly:
+            conn.set_session(readonly=True)
+        # Keep the wrapper of the connection, so that its cached table fields
+        # are reused for the next tile
+        if _worker_db is None or _worker_db.conn is not conn:
+            _worker_db = db.Db(conn=conn)
+        return export(tile, filepath, _worker_cfg, zip=zip, features=features,
+                      jsonl=jsonl, conn=_worker_db)
+    finally:
+        # A broken connection is discarded, the next tile gets a new one
+        _worker_pool.putconn(conn, close=bool(conn.closed))
+
+
+def _log_and_free(future: Future, filepath: Path, counter: itertools.count,
+                  lock: threading.Lock, total: int, failed: List,
+                  features: bool = False):
+    """Log the result of a finished tile export and record the failures.
+
+    Used as a done-callback in :func:`export_tiles_multiprocess`.
+    """
+    try:
+        success, filepath = future.result()
+    except Exception as e:
+        log.error(f"Failed to export tile {filepath.stem}\n{e}")
+        success = False
+    with lock:
+        i = next(counter)
+        if success:
+            if features:
+                log.info(f"[{i}/{total}] Saved all features from tile "
+                         f"{filepath}")
             else:
-                if features:
-                    failed.extend(filepath)
-                else:
-                    failed.append(filepath.stem)
-        log.info(
-            f"Done. Exported {len(tile_list) - len(failed)} tiles. "
-            f"Failed {len(failed)} tiles: {failed}")
-        return {"exported": len(tile_list) - len(failed),
-                "nr_failed:": len(failed),
-                "failed": failed}
+                log.info(f"[{i}/{total}] Saved {filepath.name}")
+        else:
+            if features and isinstance(filepath, list):
+                failed.extend(filepath)
+            else:
+                failed.append(filepath.stem)
 
 
-def export(tile, filepath, cfg, zip: bool = False, features: bool = False):
+def export(tile, filepath, cfg, zip: bool = False, features: bool = False,
+           jsonl: bool = False, conn: db.Db = None):
     """Export a tile from PostgreSQL, convert to CityJSON and write to file.
 
     filepath - Sth like '/path/to/myfile.city.json'. If 'features=True', then this
         filepath is further processed into '/path/to/myfile/id.city.json'
+    jsonl - Only used with 'features=True'. Write all the features of the tile
+        into a single JSON Lines file '/path/to/myfile.city.jsonl' instead of a
+        separate file per feature.
+    conn - An open connection for querying the tile, see :func:`query`.
     """
+    strict_tile_query = True if features else False
+    translate = TRANSLATE if features else None
+    # The records are streamed from the database while they are converted, so
+    # the errors of the query surface during the conversion
+    dbexport = query(conn_cfg=cfg["database"], tile_index=cfg["tile_index"],
+                     cityobject_type=cfg["cityobject_type"], threads=1,
+                     tile_list=(tile,), strict_tile_query=strict_tile_query,
+                     conn=conn, stream=True)
     try:
-        strict_tile_query = True if features else False
-        dbexport = query(conn_cfg=cfg["database"], tile_index=cfg["tile_index"],
-                         cityobject_type=cfg["cityobject_type"], threads=1,
-                         tile_list=(tile,), strict_tile_query=strict_tile_query)
-    except BaseException as e:
+        # The CityJSONFeatures don't carry the metadata of the tile, it is
+        # written once per export by export_tiles_multiprocess
+        with utils.gc_disabled():
+            cm = convert(dbexport, cfg=cfg, metadata=not features)
+            cm.compress(important_digits=IMPORTANT_DIGITS, translate=translate)
+    except Exception as e:
         log.error(f"Failed to export tile {str(tile)}\n{e}")
         return False, filepath
-    try:
-        translate = TRANSLATE if features else None
-        cm = to_citymodel(dbexport, cfg=cfg, important_digits=IMPORTANT_DIGITS,
-                          translate=translate)
     finally:
+        # Release the server-side cursor of a query that was not fully consumed
+        dbexport.close()
         del dbexport
-    if cm is not None:
-        if features:
-            fail = []
-            # e.g: 'gb2' in /home/cjio_dbexport/gb2.city.json
-            old_filename = filepath.name.replace("".join(filepath.suffixes), "")
-            # e.g: '/home/cjio_dbexport/gb2' in /home/cjio_dbexport/gb2.city.json
-            filedir = Path(filepath.parent) / old_filename
-            filedir.mkdir(exist_ok=True)
+    if features and jsonl:
+        # All the features of the tile go into a single JSON Lines file,
+        # one feature per line, e.g. /home/cjio_dbexport/gb2.city.jsonl
+        old_filename = filepath.name.replace("".join(filepath.suffixes), "")
+        filepath = filepath.parent / f"{old_filename}.city.jsonl"
+        try:
+            if zip:
+                # The lines are compressed as they are serialized, instead of
+                # joining them into one buffer first
+                lines = (utils.json_dumps(feature.j, newline=True)
+                         for feature in cm.generate_features())
+                filepath = utils.write_zip(data=lines,
+                                           filename=filepath.name,
+                                           outdir=filepath.parent,
+                                           suffix=".jsonl")
+            else:
+                with open(filepath, "wb", buffering=JSONL_BUFFER_SIZE) as fout:
+                    for feature in cm.generate_features():
+                        fout.write(utils.json_dumps(feature.j, newline=True))
+            return True, filepath
+        except IOError as e:
+            log.error(f"Invalid output file: {filepath}\n{e}")
+            return False, filepath
+        except Exception as e:
+            log.exception(e)
+            return False, filepath
+    elif features:
+        fail = []
+        # e.g: 'gb2' in /home/cjio_dbexport/gb2.city.json
+        old_filename = filepath.name.replace("".join(filepath.suffixes), "")
+        # e.g: '/home/cjio_dbexport/gb2' in /home/cjio_dbexport/gb2.city.json
+        filedir = Path(filepath.parent) / old_filename
+        filedir.mkdir(exist_ok=True)
+        # The output paths are plain strings, because building a Path for each
+        # of the many features of a tile adds up
+        filedir_prefix = os.fspath(filedir) + os.sep
+        # The features are serialized on this thread, while the writer threads
+        # write out the previous ones
+        with ThreadPoolExecutor(max_workers=FEATURE_WRITERS) as writer:
+            written = {}
             for feature in cm.generate_features():
                 feature_id = feature.j['id']
-                new_filename = f"{feature_id}.city.jsonl"
-                filepath = filedir / new_filename
+                new_filename = feature_id + ".city.jsonl"
                 try:
-                    json_str = json.dumps(feature.j, separators=(',', ':'))
-                    if zip:
-                        filepath = utils.write_zip(data=json_str.encode("utf-8"),
-                                                   filename=new_filename,
-                                                   outdir=filedir)
-                    else:
-                        with open(filepath, "w") as fout:
-                            fout.write(json_str)
-                except IOError as e:
-                    log.error(f"Invalid output file: {filepath}\n{e}")
-                    fail.append(feature_id)
-                except BaseException as e:
+                    json_bytes = utils.json_dumps(feature.j)
+                except Exception as e:
                     log.exception(e)
                     fail.append(feature_id)
-            if len(fail) > 0:
-                return False, fail
-            else:
-                return True, filedir
-        else:
-            cm.j["metadata"]["fileIdentifier"] = filepath.name
-            try:
-                json_str = json.dumps(cm.j, separators=(',', ':'))
+                    continue
                 if zip:
-                    filepath = utils.write_zip(data=json_str.encode("utf-8"),
-                                               filename=filepath.name,
-                                               outdir=filepath.parent)
+                    future = writer.submit(utils.write_zip, data=json_bytes,
+                                           filename=new_filename,
+                                           outdir=filedir)
                 else:
-                    with open(filepath, "w") as fout:
-                        fout.write(json_str)
-                return True, filepath
-            except IOError as e:
-                log.error(f"Invalid output file: {filepath}\n{e}")
-                return False, filepath
-            except BaseException as e:
-                log.exception(e)
-                return False, filepath
-            finally:
-                del cm
+                    future = writer.submit(_write_bytes, json_bytes,
+                                           filedir_prefix + new_filename)
+                written[future] = feature_id
+            for future, feature_id in written.items():
                 try:
-                    del json_str
-                except NameError:
-                    pass
+                    future.result()
+                except IOError as e:
+                    log.error(f"Invalid output file: "
+                              f"{filedir_prefix}{feature_id}.city.jsonl\n{e}")
+                    fail.append(feature_id)
+                except Exception as e:
+                    log.exception(e)
+                    fail.append(feature_id)
+        if len(fail) > 0:
+            return False, fail
+        else:
+            return True, filedir
     else:
-        log.error(
-            f"Failed to create CityJSON from {filepath.stem},"
-            f" check the logs for details."
-        )
-        return False, filepath
+        cm.j["metadata"]["fileIdentifier"] = filepath.name
+        try:
+            json_bytes = utils.json_dumps(cm.j)
+            if zip:
+                filepath = utils.write_zip(data=json_bytes,
+                                           filename=filepath.name,
+                                           outdir=filepath.parent)
+            else:
+                with open(filepath, "wb") as fout:
+                    fout.write(json_bytes)
+            return True, filepath
+        except IOError as e:
+            log.error(f"Invalid output file: {filepath}\n{e}")
+            return False, filepath
+        except Exception as e:
+            log.exception(e)
+            return False, filepath
+
+
+def _write_bytes(json_bytes: bytes, filepath: str):
+    """Write serialized JSON to a file, in a writer thread of
+    :func:`export`."""
+    with open(filepath, "wb") as fout:
+        fout.write(json_bytes)
 
 
-def to_citymodel(dbexport, cfg, important_digits: int = 3, translate=None):
+def to_citymodel(dbexport, cfg, important_digits: int = 3, translate=None,
+                 metadata: bool = True):
     try:
-        cm = convert(dbexport, cfg=cfg)
-    except BaseException as e:
+        cm = convert(dbexport, cfg=cfg, metadata=metadata)
+    except Exception as e:
         log.error(f"Failed to convert database export to CityJSON\n{e}")
         return None
     if cm:
         try:
             cm.compress(important_digits=important_digits, translate=translate)
-        except BaseException as e:
+        except Exception as e:
             log.error(f"Failed to compress cityjson\n{e}")
             return None
         return cm
 
 
-def convert(dbexport, cfg):
-    """Convert the exported citymodel to CityJSON. """
+def convert(dbexport, cfg, metadata: bool = True):
+    """Convert the exported citymodel to CityJSON.
+
+    :param metadata: Compute the metadata of the citymodel. This walks all the
+        CityObjects and vertices, so it is skipped when the metadata is not
+        needed.
+    """
     # Set EPSG
     epsg = 7415
     # Set rounding for floating point attributes
@@ -256,25 +480,33 @@ def convert(dbexport, cfg):
     cm.cityobjects = dict(dbexport_to_cityobjects(dbexport, cfg, rounding=rounding))
     log.debug("Referencing geometry and adding to json")
     cm.add_to_j()
-    log.debug("Updating metadata")
-    cm.update_metadata()
+    if metadata:
+        log.debug("Updating metadata")
+        cm.update_metadata()
     log.debug("Setting EPSG")
     cm.set_epsg(epsg)
-    log.info(f"Exported CityModel:\n{cm}")
+    # Summarizing the citymodel walks all of it, only do it when it is logged
+    if log.isEnabledFor(logging.INFO):
+        log.info(f"Exported CityModel:\n{cm}")
     return cm
 
 
 def dbexport_to_cityobjects(dbexport, cfg, rounding=4):
+    # The geometry configuration of each table, looked up by (cotype, table)
+    cfg_geom_by_table = {
+        (cotype, _c["table"]): {
+            **_c["field"]["geometry"],
+            'lod': _c["field"].get('lod'),
+            'semantics': _c["field"].get('semantics'),
+            'tile_id': _c["field"].get('tile'),
+            'semantics_mapping': cfg.get('semantics_mapping'),
+        }
+        for cotype, cotables in cfg["cityobject_type"].items()
+        for _c in cotables
+    }
     for coinfo, tabledata in dbexport:
         cotype, cotable = coinfo
-        cfg_geom = None
-        for _c in cfg["cityobject_type"][cotype]:
-            if _c["table"] == cotable:
-                cfg_geom = _c["field"]["geometry"]
-                cfg_geom['lod'] = _c["field"].get('lod')
-                cfg_geom['semantics'] = _c["field"].get('semantics')
-                cfg_geom['tile_id'] = _c["field"].get('tile')
-                cfg_geom['semantics_mapping'] = cfg.get('semantics_mapping')
+        cfg_geom = cfg_geom_by_table.get((cotype, cotable))
         # Loop through the whole tabledata and create the CityObjects
         cityobject_generator = table_to_cityobjects(
             tabledata=tabledata, cotype=cotype, cfg_geom=cfg_geom,
@@ -286,54 +518,124 @@ def dbexport_to_cityobjects(dbexport, cfg, rounding=4):
 
 def table_to_cityobjects(tabledata, cotype: str, cfg_geom: dict, rounding: int):
     """Converts a database record to a CityObject."""
+    # The attribute columns are the same for each record of the table, so they
+    # are determined once. The converter of a column is cached together with
+    # the type of the value that it was chosen for.
+    attribute_keys = None
+    converters = {}
+    columns = geometry_columns(cfg_geom)
     for record in tabledata:
         coid = str(record["coid"])
         co = CityObject(id=coid)
         # Parse the geometry
-        co.geometry = record_to_geometry(record, cfg_geom)
+        co.geometry = record_to_geometry(record, cfg_geom, columns)
         # Parse attributes, except special fields that serve some purpose,
         # eg. primary key (pk) or cityobject ID (coid)
-        special_fields = ('pk', 'coid', cfg_geom['lod'], cfg_geom['semantics'],
-                          cfg_geom['tile_id'])
-        for key, attr in record.items():
-            if key not in special_fields and "geom_" not in key:
-                if isinstance(attr, float):
-                    co.attributes[key] = round(attr, rounding)
-                elif isinstance(attr, date) or isinstance(attr, time) or isinstance(
-                        attr, datetime):
-                    co.attributes[key] = attr.isoformat()
-                elif isinstance(attr, timedelta):
-                    co.attributes[key] = str(attr)
-                else:
-                    co.attributes[key] = attr
+        if attribute_keys is None:
+            special_fields = {'pk', 'coid', cfg_geom['lod'],
+                              cfg_geom['semantics'], cfg_geom['tile_id']}
+            special_fields.update(column for column, *_ in columns)
+            attribute_keys = [key for key in record
+                              if key not in special_fields]
+        attributes = co.attributes
+        for key in attribute_keys:
+            attr = record[key]
+            if attr is None:
+                attributes[key] = attr
+                continue
+            attr_type = type(attr)
+            try:
+                cached_type, convert = converters[key]
+            except KeyError:
+                cached_type = attr_type
+                convert = attribute_converter(attr, rounding)
+                converters[key] = (cached_type, convert)
+            if attr_type is not cached_type:
+                # A json column holds values of different types in one column
+                convert = attribute_converter(attr, rounding)
+            attributes[key] = attr if convert is None else convert(attr)
         # Set the CityObject type
         co.type = cotype
         yield coid, co
 
 
-def record_to_geometry(record: Mapping, cfg_geom: dict) -> Sequence[Geometry]:
+def attribute_converter(attr, rounding: int):
+    """Return the function that converts an attribute value of this type into a
+    JSON-serializable value, or None if the value can be used as it is.
+
+    The converter is determined from the first value of a column that is not
+    NULL, and determined again for the values of a different type, eg. in a
+    json column.
+    """
+    if isinstance(attr, float):
+        return partial(round, ndigits=rounding)
+    elif isinstance(attr, (date, time)):
+        # datetime is a subclass of date
+        return _isoformat
+    elif isinstance(attr, timedelta):
+        return str
+    else:
+        return None
+
+
+def _isoformat(attr) -> str:
+    return attr.isoformat()
+
+
+def geometry_keys(cfg_geom: dict) -> List[str]:
+    """The LoD keys of the geometry columns in the geometry configuration of a
+    table, eg. ``['lod12', 'lod22']``."""
+    skip_keys = ('lod', 'semantics', 'semantics_mapping', 'tile_id')
+    return [k for k in cfg_geom if k not in skip_keys]
+
+
+def geometry_columns(cfg_geom: dict) -> List[Tuple[str, str, Optional[str],
+                                                   Optional[float]]]:
+    """The geometry columns of a table, from its geometry configuration.
+
+    :returns: A list of ``(column, geometry type, LoD, LoD as float)``, where
+        the LoD is None if it is read from the LoD column of each record.
+    """
+    lod_column = cfg_geom.get('lod')
+    columns = []
+    for lod_key in geometry_keys(cfg_geom):
+        if lod_column:
+            lod = lod_float = None
+        else:
+            lod = utils.parse_lod_value(lod_key)
+            lod_float = round(float(lod), 1)
+        columns.append((settings.geom_prefix + lod_key,
+                        cfg_geom[lod_key]["type"], lod, lod_float))
+    return columns
+
+
+def record_to_geometry(record: Mapping, cfg_geom: dict,
+                       columns: List = None) -> Sequence[Geometry]:
     """Create a CityJSON Geometry from a boundary array that was retrieved from
     Postgres.
+
+    :param columns: The geometry columns of the table as returned by
+        :func:`geometry_columns`, so that they are not worked out for each
+        record.
     """
+    if columns is None:
+        columns = geometry_columns(cfg_geom)
     geometries = []
     lod_column = cfg_geom.get('lod')
     semantics_column = cfg_geom.get('semantics')
-    skip_keys = ('lod', 'semantics', 'semantics_mapping', 'tile_id')
-    for lod_key in [k for k in cfg_geom if k not in skip_keys]:
-        if lod_column:
+    for geom_column, geomtype, lod, lod_float in columns:
+        if lod is None:
             lod = record[lod_column]
-        else:
-            lod = utils.parse_lod_value(lod_key)
-        lod_float = round(float(lod), 1)
-        geomtype = cfg_geom[lod_key]["type"]
+            lod_float = round(float(lod), 1)
         geom = Geometry(type=geomtype, lod=lod)
+        msurface = parse_wkb_multisurface(record.get(geom_column))
         if geomtype == "Solid":
             solid = [
-                record.get(settings.geom_prefix + lod_key),
+                msurface,
             ]
             geom.boundaries = solid
         elif geomtype == "MultiSurface":
-            geom.boundaries = record.get(settings.geom_prefix + lod_key)
+            geom.boundaries = msurface
         if semantics_column and lod_float >= 2.0:
             geom.surfaces = record_to_surfaces(
                 geomtype=geomtype,
@@ -349,29 +651,64 @@ def record_to_surfaces(geomtype: str, boundary: Sequence,
                        semantics: Sequence[int], semantics_mapping: dict) -> dict:
     """Create a CityJSON Semantic Surface object from an array of labels and a
     CityJSON geometry representation.
+
+    The surfaces of geometries with at least ``SEMANTICS_NUMPY_MIN_SURFACES``
+    surfaces are grouped by their label with NumPy, for fewer surfaces a Python
+    loop is faster. If the number of labels differs from the number of
+    surfaces, no semantics are assigned.
     """
-    surfaces = {}
-    for key, type in semantics_mapping.items():
-        surfaces[key] = {'surface_idx': [], 'type': type}
     if geomtype == "Solid":
         if len(boundary) > 1:
             log.warning("Cannot assign semantics to Solids with inner shell(s)")
-        shell = boundary[0]
-        if len(shell) != len(semantics):
-            log.warning("Encountered unequal sized geometry shell and semantics arrays")
-        else:
-            for i, srf in enumerate(shell):
-                surfaces[semantics[i]]['surface_idx'].append([0, i])
+        surfaces = boundary[0]
     elif geomtype == "MultiSurface":
-        for i, srf in enumerate(boundary):
-            surfaces[semantics[i]]['surface_idx'].append(i)
-    return {sem: idx for sem, idx in surfaces.items() if len(idx['surface_idx']) > 0}
+        surfaces = boundary
+    else:
+        return {}
+    if len(surfaces) != len(semantics):
+        log.warning("Encountered unequal sized geometry surfaces and semantics "
+                    "arrays")
+        return {}
+    # The surface indices of each semantic label
+    surface_idx = {key: [] for key in semantics_mapping}
+    if len(surfaces) >= SEMANTICS_NUMPY_MIN_SURFACES:
+        for label, idx in _group_by_label(semantics):
+            surface_idx[label] = idx
+    else:
+        for i in range(len(surfaces)):
+            surface_idx[semantics[i]].append(i)
+    if geomtype == "Solid":
+        surface_idx = {label: [[0, i] for i in idx]
+                       for label, idx in surface_idx.items()}
+    return {sem: {'surface_idx': idx, 'type': semantics_mapping[sem]}
+            for sem, idx in surface_idx.items() if len(idx) > 0}
+
+
+def _group_by_label(semantics: Sequence[int]):
+    """Group the surface indices by their semantic label.
+
+    :return: An iterator of ``(label, [surface index, ...])`` with the surface
+        indices in increasing order.
+    """
+    labels = np.asarray(semantics)
+    order = np.argsort(labels, kind="stable")
+    unique, starts = np.unique(labels[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    return zip(unique.tolist(), (idx.tolist() for idx in groups))
 
 
 def query(conn_cfg: Mapping, tile_index: Mapping, cityobject_type: Mapping,
           threads=None, tile_list=None, bbox=None, extent=None,
-          strict_tile_query=False):
+          strict_tile_query=False, conn: db.Db = None, stream: bool = False):
     """Export a table from PostgreSQL. Multithreading, with connection pooling.
+
+    :param conn: An open connection to use when running on a single thread. The
+        connection is left open. If None, a new connection is opened from
+        `conn_cfg` and closed when done.
+    :param stream: When running on a single thread, yield the records of a
+        table as an iterator that streams them from a server-side cursor,
+        instead of a list. The iterator of a table must be consumed before the
+        next table is requested, and while the connection is open.
     """
     # see: https://realpython.com/intro-to-python-threading/
     # see: https://stackoverflow.com/a/39310039
@@ -380,7 +717,10 @@ def query(conn_cfg: Mapping, tile_index: Mapping, cityobject_type: Mapping,
         threads = sum(len(cotables) for cotables in cityobject_type.values())
     if threads == 1:
         log.debug(f"Running on a single thread.")
-        conn = db.Db(**conn_cfg)
+        close_conn = conn is None
+        if close_conn:
+            conn = db.Db(**conn_cfg)
+            conn.conn.set_session(readonly=True)
         try:
             for cotype, cotables in cityobject_type.items():
                 for cotable in cotables:
@@ -388,10 +728,14 @@ def query(conn_cfg: Mapping, tile_index: Mapping, cityobject_type: Mapping,
                     log.debug(f"CityObject {cotype} from table {tablename}")
                     features = db.Schema(cotable)
                     tx = db.Schema(tile_index)
-                    sql_query = build_query(conn=conn, features=features, tile_index=tx,
-                                            tile_list=tile_list, bbox=bbox,
-                                            extent=extent,
-                                            strict_tile_query=strict_tile_query)
+                    sql_query = build_query(
+                        conn=conn, features=features, tile_index=tx,
+                        tile_list=tile_list, bbox=bbox, extent=extent,
+                        strict_tile_query=strict_tile_query)
+                    if stream:
+                        yield (cotype, tablename), _stream_records(
+                            conn, sql_query, cotable)
+                        continue
                     try:
                         # Note that resultset can be []
                         yield (cotype, tablename), conn.get_dict(sql_query)
@@ -402,16 +746,25 @@ def query(conn_cfg: Mapping, tile_index: Mapping, cityobject_type: Mapping,
                             f"logs for details."
                         )
         finally:
-            conn.close()
+            if close_conn:
+                conn.close()
     elif threads > 1:
         log.debug(f"Running with ThreadPoolExecutor, nr. of threads={threads}")
         pool_size = sum(len(cotables) for cotables in cityobject_type.values())
         conn_pool = pool.ThreadedConnectionPool(
             minconn=1, maxconn=pool_size + 1, **conn_cfg
         )
+        # The fetching threads hand over the resultsets through a queue, so
+        # that the conversion of a table in the consumer overlaps with the
+        # fetching of the next tables. A fetch only starts when it acquired a
+        # slot, which the consumer releases when it is done with a resultset,
+        # so that at most QUEUE_SIZE resultsets are held in memory at once.
+        resultsets = queue.Queue()
+        slots = threading.Semaphore(QUEUE_SIZE)
+        cancelled = threading.Event()
         try:
             with ThreadPoolExecutor(max_workers=threads) as executor:
-                future_to_table = {}
+                nr_tables = 0
                 for cotype, cotables in cityobject_type.items():
                     # Need a thread for each of these
                     for cotable in cotables:
@@ -422,37 +775,86 @@ def query(conn_cfg: Mapping, tile_index: Mapping, cityobject_type: Mapping,
                         log.debug(f"CityObject {cotype} from table {cotable['table']}")
                         features = db.Schema(cotable)
                         tx = db.Schema(tile_index)
-                        sql_query = build_query(conn=conn, features=features,
-                                                tile_index=tx, tile_list=tile_list,
-                                                bbox=bbox, extent=extent,
-                                                strict_tile_query=strict_tile_query)
-                        # Schedule the DB query for execution and store the returned
-                        # Future together with the cotype and table name
-                        future = executor.submit(conn.get_dict, sql_query)
-                        future_to_table[future] = (cotype, tablename)
-                        # If I put away the connection here, then it locks the main
-                        # thread and it becomes like using a single connection.
-                        # conn_pool.putconn(conn=conn.conn, key=(cotype, tablename),
-                        #                   close=True)
-                for future in as_completed(future_to_table):
-                    cotype, tablename = future_to_table[future]
-                    try:
+                        sql_query = build_query(
+                            conn=conn, features=features, tile_index=tx,
+                            tile_list=tile_list, bbox=bbox, extent=extent,
+                            strict_tile_query=strict_tile_query)
+                        # Schedule the DB query, the result is put on the queue
+                        # together with the cotype and table name
+                        executor.submit(_fetch_to_queue, conn_pool, conn,
+                                        (cotype, tablename), sql_query,
+                                        resultsets, slots, cancelled)
+                        nr_tables += 1
+                try:
+                    for _ in range(nr_tables):
+                        key, resultset, error = resultsets.get()
+                        cotype, tablename = key
+                        if error is not None:
+                            if not isinstance(error, pgError):
+                                raise error
+                            log.error(f"{error.pgcode}\t{error.pgerror}")
+                            raise ClickException(
+                                f"Could not query {tablename}. Check the "
+                                f"logs for details."
+                            )
                         # Note that resultset can be []
-                        yield (cotype, tablename), future.result()
-                    except pgError as e:
-                        log.error(f"{e.pgcode}\t{e.pgerror}")
-                        raise ClickException(
-                            f"Could not query {tablename}. Check the "
-                            f"logs for details."
-                        )
+                        yield (cotype, tablename), resultset
+                        del resultset
+                        slots.release()
+                finally:
+                    # Release the threads that are still waiting for a free
+                    # slot, in case the consumer stopped early
+                    cancelled.set()
         finally:
             conn_pool.closeall()
     else:
         raise ValueError(f"Number of threads must be greater than 0.")
 
 
-def build_query(conn: db.Db, features: db.Schema, tile_index: db.Schema, tile_list=None,
-                bbox=None, extent=None, strict_tile_query=False):
+def _stream_records(conn: db.Db, sql_query: sql.Composed, cotable: Mapping):
+    """Stream the records of a table query, for :func:`query` with
+    `stream=True`."""
+    try:
+        yield from conn.get_dict_iter(sql_query, itersize=STREAM_ITERSIZE)
+    except pgError as e:
+        log.error(f"{e.pgcode}\t{e.pgerror}")
+        raise ClickException(
+            f"Could not query {cotable}. Check the "
+            f"logs for details."
+        )
+
+
+def _fetch_to_queue(conn_pool: pool.ThreadedConnectionPool, conn: db.Db,
+                    key: Tuple[str, str], sql_query: sql.Composed,
+                    resultsets: queue.Queue, slots: threading.Semaphore,
+                    cancelled: threading.Event):
+    """Run a query on a pooled connection and put the result on the queue.
+
+    The query only runs after it acquired one of the ``slots``, which the
+    consumer releases when it is done with the resultset. The item on the queue
+    is a tuple of ``(key, resultset, error)``, where ``error`` is the exception
+    that was raised by the query or by returning the connection to the pool, or
+    None. An item is always put on the queue, because the consumer waits for
+    one item per table, unless the consumer was cancelled before the query
+    could run.
+    """
+    try:
+        try:
+            while not slots.acquire(timeout=0.1):
+                if cancelled.is_set():
+                    return
+            resultset = conn.get_dict(sql_query)
+        finally:
+            conn_pool.putconn(conn=conn.conn, key=key)
+        item = (key, resultset, None)
+    except Exception as e:
+        item = (key, None, e)
+    resultsets.put(item)
+
+
+def build_query(conn: db.Db, features: db.Schema, tile_index: db.Schema,
+                tile_list=None, bbox=None, extent=None,
+                strict_tile_query=False):
     """Build an SQL query for extracting CityObjects from a single table.
 
     ..todo: make EPSG a parameter
@@ -475,7 +877,7 @@ def build_query(conn: db.Db, features: db.Schema, tile_index: db.Schema, tile_li
         for lod in features.field.geometry.keys()
     ]
     attr_select = sql.SQL(", ").join(
-        sql.Identifier(col)
+        sql_identifier(col)
         for col in table_fields
         if col != features.field.pk.string
         and col not in geom_cols
@@ -538,7 +940,8 @@ def build_query(conn: db.Db, features: db.Schema, tile_index: db.Schema, tile_li
         b.pk = a.pk;
     """
     ).format(**query_params)
-    log.debug(conn.print_query(query))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(conn.print_query(query))
     return query
 
 
@@ -589,6 +992,12 @@ def query_bbox(
         "tbl": features.schema + features.table,
     }
 
+    # ST_3DIntersects can only use an n-D index, the '&&' bounding box test
+    # lets the 2D GiST index of the geometry filter the candidates first
+    query_params["envelope"] = sql.SQL(
+        "ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {epsg})"
+    ).format(**query_params)
+
     sql_polygons = sql.SQL(
         """
     polygons AS (
@@ -596,20 +1005,16 @@ def query_bbox(
                {geometries}
         FROM
             {tbl}
-        WHERE ST_3DIntersects(
-            {geometry_0},
-            ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {epsg})
-            )
+        WHERE {geometry_0} && {envelope}
+          AND ST_3DIntersects({geometry_0}, {envelope})
     )
     """
     ).format(**query_params)
 
     sql_where_attr_intersects = sql.SQL(
         """
-    WHERE ST_3DIntersects(
-        a.{geometry_0},
-        ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {epsg})
-        )
+    WHERE a.{geometry_0} && {envelope}
+      AND ST_3DIntersects(a.{geometry_0}, {envelope})
     """
     ).format(**query_params)
 
@@ -631,6 +1036,7 @@ def query_extent(features: db.Schema, ewkt: str) -> Tuple[sql.Composed, ...]:
         "poly": sql.Literal(ewkt),
     }
 
+    # See query_bbox for the '&&' test
     sql_polygons = sql.SQL(
         """
     polygons AS (
@@ -639,20 +1045,16 @@ def query_extent(features: db.Schema, ewkt: str) -> Tuple[sql.Composed, ...]:
             {geometries}
         FROM
             {tbl}
-        WHERE ST_3DIntersects(
-            {geometry_0},
-            {poly}
-            )
+        WHERE {geometry_0} && {poly}::geometry
+          AND ST_3DIntersects({geometry_0}, {poly})
     )
     """
     ).format(**query_params)
 
     sql_where_attr_intersects = sql.SQL(
         """
-    WHERE ST_3DIntersects(
-        a.{geometry_0},
-        {poly}
-        )
+    WHERE a.{geometry_0} && {poly}::geometry
+      AND ST_3DIntersects(a.{geometry_0}, {poly})
     """
     ).format(**query_params)
 
@@ -665,21 +1067,23 @@ def query_tiles_in_list(features: db.Schema, tile_index: db.Schema,
                         tile_list: Sequence[str], with_intersection: bool = True,
                         strict=False) -> Tuple[sql.Composed, ...]:
     """Build a subquery of the geometry in the tile list.
-    :param strict: If true, create a 1-to-1 mapping of feature-tile. If false, create a
-        1-to-many mapping (one feature can belong to multiple tiles). Requires that the
-        feature geometry is indexed as `... USING gist (st_centroid(geometry))`,
-        otherwise the spatial index won't be used for the query.
+    :param strict: If true, create a 1-to-1 mapping of feature-tile. If false,
+        create a 1-to-many mapping (one feature can belong to multiple tiles).
+        Requires that the feature geometry is indexed as `... USING gist
+        (st_centroid(geometry))`, otherwise the spatial index won't be used for
+        the query. If false, the feature geometry itself should be indexed as
+        `... USING gist (geometry)`.
     :param features:
     :param tile_index:
     :param tile_list:
-    :param with_intersection: If True, use an intersection query (3DIntersects) for
-        finding the objects that intersect with the tile boundaries. If False, filter
-        the objects whose tile ID is in the `tile_list`. If False, it expects that the
-        table contains a column with a one-to-one mapping of objects and tile IDs. This
-        column is declared in the cityobject_types.<CO>.field.tile tag.
+    :param with_intersection: If True, use an intersection query
+        (ST_Intersects) for finding the objects that intersect with the tile
+        boundaries. If False, filter the objects whose tile ID is in the
+        `tile_list`. If False, it expects that the table contains a column with
+        a one-to-one mapping of objects and tile IDs. This column is declared
+        in the cityobject_types.<CO>.field.tile tag.
     :return:
     """
-    tl_tup = tuple(tile_list)
     # One geometry column is enough to restrict the selection to the BBOX
     lod = list(features.field.geometry.keys())[0]
     query_params = {
@@ -693,72 +1097,80 @@ def query_tiles_in_list(features: db.Schema, tile_index: db.Schema,
         "tx_geom": tile_index.field.geometry.sqlid,
         "tx_geom_sw": tile_index.field.geometry_sw_boundary.sqlid,
         "tx_pk": tile_index.field.pk.sqlid,
-        "tile_list": sql.Literal(tl_tup),
+        "tile_list": db.array_literal(tile_list),
+        "tx_where": sql_where_tiles(tile_index, tile_list),
     }
+    # With all the tiles there is no need to send the list of tile IDs
+    if is_all_tiles(tile_list):
+        query_params["tile_in_list"] = sql.SQL(
+            "{tbl_tile} IS NOT NULL").format(**query_params)
+    else:
+        query_params["tile_in_list"] = sql.SQL(
+            "{tbl_tile} = ANY({tile_list})").format(**query_params)
 
     if with_intersection:
+        # The predicate that selects the objects in the extent is the same for
+        # the geometry and the attributes, so it is composed once for both
         if strict:
             sql_extent = sql.SQL(
                 """
             extent AS (
                 SELECT ST_Union({tx_geom}) AS geom, ST_Union({tx_geom_sw}) AS geom_sw
                 FROM {tile_index}
-                WHERE {tx_pk} IN {tile_list}),
+                {tx_where}),
             """
             ).format(**query_params)
 
-            sql_polygon = sql.SQL(
-                """
-            geom_in_extent AS (
-                SELECT a.*
-                FROM {tbl} a,
-                     extent t
-                WHERE ST_ContainsProperly(t.geom, ST_Centroid(a.{tbl_geom}))
-                   OR ST_3DIntersects(t.geom_sw, ST_Centroid(a.{tbl_geom})))
-            ,polygons AS (
-                SELECT 
-                    {tbl_pk} pk,
-                    {geometries}
-                FROM geom_in_extent b)
-            """
-            ).format(**query_params)
-
-            sql_where_attr_intersects = sql.SQL(
-                """
-            ,extent t WHERE ST_ContainsProperly(t.geom, ST_Centroid(a.{tbl_geom}))
-                         OR ST_3DIntersects(t.geom_sw, ST_Centroid(a.{tbl_geom}))
-            """
+            query_params["in_extent"] = sql.SQL(
+                """t.geom && ST_Centroid(a.{tbl_geom})
+                  AND (ST_ContainsProperly(t.geom, ST_Centroid(a.{tbl_geom}))
+                       OR ST_3DIntersects(t.geom_sw,
+                                          ST_Centroid(a.{tbl_geom})))"""
             ).format(**query_params)
+            query_params["extent_from"] = sql.SQL(", extent t")
         else:
-            sql_extent = sql.SQL(
-                """
-            extent AS (
-                SELECT ST_Union({tx_geom}) geom
-                FROM {tile_index}
-                WHERE {tx_pk} IN {tile_list}),
-            """
+            # The objects are matched against each tile of the list, instead of
+            # against the union of the tiles that GEOS would have to compute
+            # first. The join is driven from the few selected tiles, so the
+            # spatial index of the table is probed once per tile. The subquery
+            # is not correlated with the outer table, which would otherwise be
+            # scanned in full to evaluate the predicate for each of its rows.
+            if is_all_tiles(tile_list):
+                query_params["tile_cond"] = sql.Composed("")
+            else:
+                query_params["tile_cond"] = sql.SQL(
+                    "WHERE t.{tx_pk} = ANY({tile_list})"
+                ).format(**query_params)
+            sql_extent = sql.Composed("")
+            query_params["extent_from"] = sql.Composed("")
+            query_params["in_extent"] = sql.SQL(
+                """a.{tbl_pk} IN (
+                    SELECT b.{tbl_pk}
+                    FROM {tile_index} t
+                        JOIN {tbl} b ON t.{tx_geom} && b.{tbl_geom}
+                            AND ST_Intersects(t.{tx_geom}, b.{tbl_geom})
+                    {tile_cond})"""
             ).format(**query_params)
 
-            sql_polygon = sql.SQL(
-                """
-            geom_in_extent AS (
-                SELECT a.*
-                FROM {tbl} a,
-                     extent t
-                WHERE ST_3DIntersects(t.geom, a.{tbl_geom}))
-            ,polygons AS (
-                SELECT 
-                    {tbl_pk} pk,
-                    {geometries}
-                FROM geom_in_extent b)
+        sql_polygon = sql.SQL(
             """
-            ).format(**query_params)
+        geom_in_extent AS (
+            SELECT a.*
+            FROM {tbl} a{extent_from}
+            WHERE {in_extent})
+        ,polygons AS (
+            SELECT 
+                {tbl_pk} pk,
+                {geometries}
+            FROM geom_in_extent b)
+        """
+        ).format(**query_params)
 
-            sql_where_attr_intersects = sql.SQL(
-                """
-            ,extent t WHERE ST_3DIntersects(t.geom, a.{tbl_geom})
+        sql_where_attr_intersects = sql.SQL(
             """
-            ).format(**query_params)
+        {extent_from} WHERE {in_extent}
+        """
+        ).format(**query_params)
     else:
         sql_polygon = sql.SQL(
             """
@@ -767,13 +1179,13 @@ def query_tiles_in_list(features: db.Schema, tile_index: db.Schema,
                 {tbl_pk} pk,
                 {geometries}
             FROM {tbl} b
-            WHERE b.{tbl_tile} IN {tile_list}
+            WHERE b.{tile_in_list}
             )
         """
         ).format(**query_params)
 
         sql_where_attr_intersects = sql.SQL("""
-        WHERE {tbl_tile} IN {tile_list}
+        WHERE {tile_in_list}
         """).format(**query_params)
 
         sql_extent = sql.Composed("")
@@ -781,9 +1193,32 @@ def query_tiles_in_list(features: db.Schema, tile_index: db.Schema,
     return sql_polygon, sql_where_attr_intersects, sql_extent
 
 
+def sql_where_tiles(tile_index: db.Schema,
+                    tile_list: Sequence[str]) -> sql.Composed:
+    """Create a WHERE clause that selects the tiles of the tile list from the
+    tile index. With ``ALL_TILES`` there is no WHERE clause."""
+    if is_all_tiles(tile_list):
+        return sql.Composed("")
+    # '= ANY' of an array is an index condition of the primary key B-tree, and
+    # PostgreSQL sorts and deduplicates the array keys for the index scan
+    # itself. Unlike a join to 'unnest()', it needs no type for the array, so
+    # the untyped literal works with both text and integer tile IDs.
+    return sql.SQL("WHERE {tx_pk} = ANY({tile_list})").format(
+        tx_pk=tile_index.field.pk.sqlid, tile_list=db.array_literal(tile_list))
+
+
+def is_all_tiles(tile_list: Sequence[str]) -> bool:
+    """Is the tile list the ``ALL_TILES`` selection, eg. ``('all',)``?"""
+    return len(tile_list) == 1 and str(tile_list[0]).strip().lower() == "all"
+
+
 def with_list(conn: db.Db, tile_index: db.Schema, tile_list: Tuple[str]) -> List[str]:
-    """Select tiles based on a list of tile IDs."""
-    if "all" == tile_list[0].lower():
+    """Select tiles based on a list of tile IDs.
+
+    Duplicate tile IDs are removed, keeping the order of the first occurrence.
+    """
+    tile_list = list(dict.fromkeys(str(tile).strip() for tile in tile_list))
+    if is_all_tiles(tile_list):
         log.info("Getting all tiles from the index.")
         in_index = all_in_index(conn=conn, tile_index=tile_index)
     else:
@@ -797,28 +1232,34 @@ def with_list(conn: db.Db, tile_index: db.Schema, tile_list: Tuple[str]) -> List
 
 def tiles_in_index(
         conn: db.Db, tile_index: db.Schema, tile_list: Tuple[str]
-) -> Tuple[List[str], List[str]]:
-    """Return the tile IDs that are present in the tile index."""
-    if not isinstance(tile_list, tuple):
-        tile_list = tuple(tile_list)
-        log.debug(f"tile_list was not a tuple, casted to tuple {tile_list}")
+) -> List[str]:
+    """Return the tile IDs that are present in the tile index.
 
+    The tile IDs are compared to the key column of the index with its own type,
+    through an untyped array literal (see :func:`sql_where_tiles`), so that the
+    primary key index of the tile index is used. The tiles are returned in the
+    order of `tile_list`.
+    """
     query_params = {
-        "tiles": sql.Literal(tile_list),
         "index_": tile_index.schema + tile_index.table,
         "tile": tile_index.field.pk.sqlid,
+        "tx_where": sql_where_tiles(tile_index, tile_list),
     }
     query = sql.SQL(
         """
-    SELECT DISTINCT {tile}
-    FROM {index_}
-    WHERE {tile} IN {tiles}
+    SELECT {tile}::text FROM {index_} {tx_where}
     """
     ).format(**query_params)
-    log.debug(conn.print_query(query))
-    # FIXME: should create a tuple here or not? see also 'with_list'
-    in_index = [t[0] for t in conn.get_query(query)]
-    not_found = set(tile_list) - set(in_index)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(conn.print_query(query))
+    found = {tile for (tile,) in conn.get_query_iter(query)}
+    in_index = []
+    not_found = []
+    for tile in tile_list:
+        if str(tile) in found:
+            in_index.append(tile)
+        else:
+            not_found.append(tile)
     if len(not_found) > 0:
         log.warning(
             f"The provided tile IDs {not_found} are not in the index, "
@@ -828,34 +1269,155 @@ def tiles_in_index(
 
 
 def all_in_index(conn: db.Db, tile_index: db.Schema) -> List[str]:
-    """Get all tile IDs from the tile index."""
+    """Get all tile IDs from the tile index.
+
+    The tile IDs are usually the primary key of the index, so they are
+    deduplicated in Python instead of with a ``DISTINCT`` that the database
+    would sort or hash for nothing.
+    """
     query_params = {
         "index_": tile_index.schema + tile_index.table,
         "tile": tile_index.field.pk.sqlid,
     }
     query = sql.SQL(
         """
-    SELECT DISTINCT {tile} FROM {index_}
+    SELECT {tile} FROM {index_}
     """
     ).format(**query_params)
-    log.debug(conn.print_query(query))
-    return [t[0] for t in conn.get_query(query)]
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(conn.print_query(query))
+    # Unpack the single-column rows in the comprehension, not by indexing
+    return list(dict.fromkeys(tile for (tile,) in conn.get_query_iter(query)))
 
 
 def parse_polygonz(wkt_polygonz):
-    """Parses a POLYGON Z array of WKT into CityJSON Surface"""
-    # match: 'POLYGON Z (<match everything in here>)'
-    outer_pat = re.compile(r"(?<=POLYGON Z \().*(?!$)")
-    # match: '(<match everything in here>)'
-    ring_pat = re.compile(r"\(([^)]+)\)")
-    outer = outer_pat.findall(wkt_polygonz)
-    if len(outer) > 0:
-        rings = ring_pat.findall(outer[0])
-        for ring in rings:
+    """Parses a POLYGON Z array of WKT into CityJSON Surface
+
+    The WKT is scanned once from left to right, each ring is located by its
+    parentheses. The coordinates of rings with at least
+    ``WKT_NUMPY_MIN_POINTS`` vertices are converted by NumPy in a single call,
+    for smaller rings the overhead of NumPy is more than the conversion itself.
+    """
+    start = -1
+    if wkt_polygonz.startswith(POLYGONZ_PREFIX):
+        start = wkt_polygonz.find("(", len(POLYGONZ_PREFIX))
+    end = wkt_polygonz.rfind(")")
+    if start < 0 or end <= start:
+        log.error("Not a POLYGON Z")
+        return
+    ring_start = wkt_polygonz.find("(", start + 1, end)
+    while ring_start >= 0:
+        ring_end = wkt_polygonz.find(")", ring_start, end)
+        if ring_end < 0:
+            break
+        ring = wkt_polygonz[ring_start + 1:ring_end]
+        if ring.count(",") + 1 >= WKT_NUMPY_MIN_POINTS:
+            coords = np.fromstring(ring.replace(",", " "), sep=" ")
+            coords = coords.reshape(-1, 3)
+            pts = list(map(tuple, coords.tolist()))
+        else:
             pts = [tuple(map(float, pt.split())) for pt in ring.split(",")]
-            yield pts[1:]  # WKT repeats the first vertex
+        yield pts[1:]  # WKT repeats the first vertex
+        ring_start = wkt_polygonz.find("(", ring_end, end)
+
+
+def parse_wkb_multisurface(wkb) -> List:
+    """Parses a (Multi)Polygon Z WKB into a CityJSON MultiSurface boundary
+    array.
+
+    Supports the Polygon, Triangle, MultiPolygon, PolyhedralSurface and TIN
+    geometry types, both as ISO WKB and as PostGIS EWKB. The coordinates of a
+    ring are read in one go with NumPy. The last vertex of each ring is
+    dropped, because WKB repeats the first vertex.
+
+    :param wkb: The WKB as bytes or memoryview, or None
+    :returns: A list of surfaces, where each surface is a list of rings, and
+        each ring is a list of [x, y, z] coordinates. None if `wkb` is None.
+    """
+    if wkb is None:
+        return None
+    surfaces, _ = _parse_wkb_surfaces(memoryview(wkb), 0)
+    return surfaces
+
+
+def _parse_wkb_header(buf: memoryview,
+                      offset: int) -> Tuple[str, int, bool, int, int]:
+    """Parse the header of a WKB geometry that starts at `offset`.
+
+    :returns: (byte order, geometry type, has Z, nr. of dimensions, offset of
+        the geometry body)
+    """
+    byteorder = "<" if buf[offset] == 1 else ">"
+    (gtype,) = struct.unpack_from(byteorder + "I", buf, offset + 1)
+    offset += 5
+    # PostGIS EWKB flags
+    has_z = bool(gtype & 0x80000000)
+    has_m = bool(gtype & 0x40000000)
+    if gtype & 0x20000000:
+        # Skip the SRID
+        offset += 4
+    gtype &= 0x0FFFFFFF
+    # ISO WKB, eg. 1006 is MultiPolygon Z, 3006 is MultiPolygon ZM
+    if gtype >= 1000:
+        has_z = gtype // 1000 in (1, 3)
+        has_m = gtype // 1000 in (2, 3)
+        gtype %= 1000
+    return byteorder, gtype, has_z, 2 + has_z + has_m, offset
+
+
+def _parse_wkb_surfaces(buf: memoryview, offset: int) -> Tuple[List, int]:
+    """Parse the WKB geometry that starts at `offset` into a list of surfaces.
+
+    :returns: (surfaces, offset of the next geometry)
+    """
+    byteorder, gtype, has_z, dims, offset = _parse_wkb_header(buf, offset)
+    if gtype in (WKB_POLYGON, WKB_TRIANGLE):
+        surface, offset = _parse_wkb_rings(buf, offset, byteorder, has_z, dims)
+        return [surface, ], offset
+    elif gtype in (WKB_MULTIPOLYGON, WKB_POLYHEDRALSURFACE, WKB_TIN):
+        (nr_geoms,) = struct.unpack_from(byteorder + "I", buf, offset)
+        offset += 4
+        surfaces = []
+        for _ in range(nr_geoms):
+            polygon, offset = _parse_wkb_surfaces(buf, offset)
+            surfaces.extend(polygon)
+        return surfaces, offset
     else:
-        log.error("Not a POLYGON Z")
+        raise ValueError(f"Unsupported WKB geometry type {gtype}")
+
+
+def _parse_wkb_rings(buf: memoryview, offset: int, byteorder: str, has_z: bool,
+                     dims: int) -> Tuple[List, int]:
+    """Parse the rings of a WKB Polygon body that starts at `offset`.
+
+    :returns: (rings, offset of the next geometry)
+    """
+    (nr_rings,) = struct.unpack_from(byteorder + "I", buf, offset)
+    offset += 4
+    dtype = np.dtype(byteorder + "f8")
+    rings = []
+    for _ in range(nr_rings):
+        (nr_points,) = struct.unpack_from(byteorder + "I", buf, offset)
+        offset += 4
+        coords = np.frombuffer(buf, dtype=dtype, count=nr_points * dims,
+                               offset=offset).reshape(nr_points, dims)[:-1]
+        offset += nr_points * dims * 8
+        if has_z:
+            coords = coords[:, :3]
+        else:
+            coords = np.column_stack((coords[:, :2], np.zeros(len(coords))))
+        rings.append(coords.tolist())
+    return rings, offset
+
+
+@lru_cache(maxsize=512)
+def sql_identifier(name: str) -> sql.Identifier:
+    """Return a cached :class:`psycopg2.sql.Identifier` for a column name.
+
+    The same column names are composed into the query of each table for each
+    tile, so they are only wrapped once per process.
+    """
+    return sql.Identifier(name)
 
 
 def sql_cast_geometry(features: db.Schema) -> sql.Composed:
@@ -863,47 +1425,132 @@ def sql_cast_geometry(features: db.Schema) -> sql.Composed:
 
     For each geometry column in the table (one column per LoD) that is mapped in
     the configuration file, prepare the clauses for the SELECT statement.
+    The geometry is selected as little-endian WKB, which is parsed by
+    :func:`parse_wkb_multisurface`.
 
     :return: An SQL snippent for example:
-        'cjdb_multipolygon_to_multisurface(wkb_geometry_lod1) geom_lod1,
-         cjdb_multipolygon_to_multisurface(wkb_geometry_lod2) geom_lod2'
+        'ST_AsBinary(wkb_geometry_lod1, 'NDR') geom_lod1,
+         ST_AsBinary(wkb_geometry_lod2, 'NDR') geom_lod2'
     """
+    # Each attribute access on a Schema creates a new Schema, so only walk the
+    # path to the geometry fields once
+    geom_fields = features.field.geometry
+    prefix = settings.geom_prefix
+    template = sql.SQL("ST_AsBinary({geom_field}, 'NDR') {geom_alias}")
     lod_fields = [
-        sql.SQL("cjdb_multipolygon_to_multisurface({geom_field}) {geom_alias}").format(
-            geom_field=getattr(features.field.geometry, lod).name.sqlid,
-            geom_alias=sql.Identifier(settings.geom_prefix + lod),
+        template.format(
+            geom_field=getattr(geom_fields, lod).name.sqlid,
+            geom_alias=sql_identifier(prefix + lod),
         )
-        for lod in features.field.geometry.keys()
+        for lod in geom_fields.keys()
     ]
     return sql.SQL(",").join(lod_fields)
 
 
-def index_geometry_centroid(conn, cfg: Mapping) -> bool:
+def index_geometry_centroid(conn, cfg: Mapping, method: str = "gist") -> bool:
+    """Create a spatial index on the geometry centroids of the cityobject
+    tables.
+
+    :param method: The index access method, one of ``INDEX_METHODS``. SP-GiST
+        indexes on points are smaller and faster to build than GiST. BRIN is
+        the smallest, but it is only effective if the table rows are spatially
+        clustered (e.g. after a ``CLUSTER`` on a spatial index).
+    """
+    if method not in INDEX_METHODS:
+        raise ValueError(f"Index method must be one of {INDEX_METHODS}, "
+                         f"got {method}")
+    template = sql.SQL("""
+            CREATE INDEX IF NOT EXISTS {idx_name} 
+            ON {table} 
+            USING {method} (ST_Centroid({geometry})) {storage}
+            """)
+    method_sql = sql.SQL(method)
+    storage_sql = sql.SQL(INDEX_METHODS[method])
+    statements = []
+    for features, geom_col_name in _indexed_tables(cfg):
+        query_params = {
+            'table': features.schema + features.table,
+            'geometry': geom_col_name.sqlid,
+            'idx_name': centroid_index_name(features, geom_col_name, method),
+            'method': method_sql,
+            'storage': storage_sql,
+        }
+        statements.append(template.format(**query_params))
+    set_work_mem = sql.SQL("SET LOCAL maintenance_work_mem = {}").format(
+        sql.Literal(MAINTENANCE_WORK_MEM))
+    # Create all the indexes in a single transaction, thus in one round trip
+    query = sql.SQL(";").join([set_work_mem] + statements)
+    try:
+        log.debug(conn.print_query(query))
+        conn.send_query(query)
+        return True
+    except pgError as e:
+        log.error(f"{e.pgcode}\t{e.pgerror}")
+        log.info("Could not create the indexes in a single transaction, "
+                 "creating them one by one.")
+    results = []
+    for statement in statements:
+        # Each statement runs in its own transaction, where SET LOCAL applies
+        query = sql.SQL(";").join([set_work_mem, statement])
+        ok = True
+        try:
+            log.debug(conn.print_query(query))
+            conn.send_query(query)
+        except pgError as e:
+            log.error(f"{e.pgcode}\t{e.pgerror}")
+            ok = False
+        results.append(ok)
+
+    return all(results)
+
+
+def cluster_geometry_centroid(conn, cfg: Mapping) -> bool:
+    """Cluster the cityobject tables on the GiST index of their geometry
+    centroids, and analyze them.
+
+    Clustering puts the objects that are close to each other on the same pages,
+    so that a tile is read from fewer pages. The order is not maintained for
+    new or updated rows, so the tables need to be clustered again after larger
+    changes. The GiST index is created by :func:`index_geometry_centroid`.
+    """
+    template = sql.SQL("CLUSTER {table} USING {idx_name}; ANALYZE {table}")
     results = []
+    for features, geom_col_name in _indexed_tables(cfg):
+        query = template.format(
+            table=features.schema + features.table,
+            idx_name=centroid_index_name(features, geom_col_name, "gist"),
+        )
+        ok = True
+        try:
+            log.debug(conn.print_query(query))
+            conn.send_query(query)
+        except pgError as e:
+            log.error(f"{e.pgcode}\t{e.pgerror}")
+            ok = False
+        results.append(ok)
+    return all(results)
+
+
+def _indexed_tables(cfg: Mapping) -> Iterable[Tuple[db.Schema, db.DbRelation]]:
+    """The cityobject tables and their geometry column that is indexed.
+
+    It is enough to index one geometry column (in case there are multiple, with
+    different LoD-s), because always the first LoD is used in the queries.
+    """
     for cotype, cotables in cfg['cityobject_type'].items():
         for cotable in cotables:
             features = db.Schema(cotable)
-            # It is enough to index one geometry column (in case there are multiple,
-            # with different LoD-s), because always the first LoD is used in the
-            # queries (see above).
-            lod = list(features.field.geometry.keys())[0]
-            geom_col_name = getattr(features.field.geometry, lod).name
-            query_params = {
-                'table': features.schema + features.table,
-                'geometry': geom_col_name.sqlid,
-                'idx_name': sql.Identifier("_".join([features.table.string, geom_col_name.string, 'centroid_idx']))
-            }
-            query = sql.SQL("""
-            CREATE INDEX IF NOT EXISTS {idx_name} 
-            ON {table} 
-            USING gist (ST_Centroid({geometry}))
-            """).format(**query_params)
-            try:
-                log.debug(conn.print_query(query))
-                conn.send_query(query)
-            except pgError as e:
-                log.error(f"{e.pgcode}\t{e.pgerror}")
-                results.append(False)
-            results.append(True)
-
-    return all(results)
\ No newline at end of file
+            geom_fields = features.field.geometry
+            lod = next(iter(geom_fields.keys()))
+            yield features, getattr(geom_fields, lod).name
+
+
+def centroid_index_name(features: db.Schema, geom_col_name: db.DbRelation,
+                        method: str = "gist") -> sql.Identifier:
+    """The name of the index on the geometry centroids of a table."""
+    if method == "gist":
+        idx_suffix = 'centroid_idx'
+    else:
+        idx_suffix = f'centroid_{method}_idx'
+    return sql.Identifier(
+        "_".join([features.table.string, geom_col_name.string, idx_suffix]))
@@ -23,17 +23,33 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
 SOFTWARE.
 """
+import gc
+import io
 import json
 import math
+import shutil
+from contextlib import contextmanager
 from statistics import mean
-from typing import Iterable, Tuple, Mapping, TextIO, Union
+from typing import Iterable, Tuple, Mapping, TextIO, Union, BinaryIO
 import logging
 import zipfile, gzip
 from platform import platform
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
+# Chunk size for copying the data into a compressed archive
+ZIP_CHUNK_SIZE = 1024 * 1024
+# Compression level of the archives. CityJSON is very repetitive, so the
+# fastest level compresses nearly as well as the default level, at a fraction
+# of the time.
+ZIP_COMPRESSLEVEL = 1
+
 def create_rectangle_grid(bbox: Iterable[float], hspacing: float,
                           vspacing: float) -> Iterable:
     """
@@ -371,23 +387,83 @@ def parse_lod_value(lod_key: str) -> str:
         raise ValueError(f"Invalid LoD value '{value}' in key {lod_key}")
 
 
-def write_zip(data: bytes, filename: str, outdir: Path):
+def write_zip(data: Union[bytes, BinaryIO, Iterable[bytes]], filename: str,
+              outdir: Path, suffix: str = ".json"):
     """Write out a citymodel to a zip file.
 
     On Linux and MacOS it uses Gzip, on Windows it uses Zip.
 
-    :param data: Data to compress into a file
+    The data is copied into the archive in chunks of ``ZIP_CHUNK_SIZE`` and
+    compressed with ``ZIP_COMPRESSLEVEL``.
+
+    :param data: Data to compress into a file, either as bytes, as a readable
+        binary file object, or as an iterable of bytes that are written one
+        after the other (eg. the lines of a JSON Lines file)
     :param filename: Filename to write
     :param outdir: Output directory
+    :param suffix: The suffix of the compressed file in the name of the
+        archive, eg. ``.jsonl`` for ``gb2.city.jsonl.gz``
     """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = io.BytesIO(data)
     outfile = outdir / filename
     if "windows" in platform().lower():
-        outzip = outfile.with_suffix(".zip")
-        with zipfile.ZipFile(file=outzip, mode="w") as zout:
-            zout.writestr(zinfo_or_arcname=filename,
-                          data=data)
+        zip_suffix = ".zip" if suffix == ".json" else suffix + ".zip"
+        outzip = outfile.with_suffix(zip_suffix)
+        with zipfile.ZipFile(file=outzip, mode="w",
+                             compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=ZIP_COMPRESSLEVEL) as zout:
+            with zout.open(filename, mode="w") as zmember:
+                _copy_data(data, zmember)
+    else:
+        outzip = outfile.with_suffix(suffix + ".gz")
+        with gzip.open(outzip, "w", compresslevel=ZIP_COMPRESSLEVEL) as zout:
+            _copy_data(data, zout)
+    return outzip
+
+
+def _copy_data(data: Union[BinaryIO, Iterable[bytes]], fout: BinaryIO):
+    """Copy a file object or the chunks of an iterable into `fout`."""
+    if hasattr(data, "read"):
+        shutil.copyfileobj(data, fout, ZIP_CHUNK_SIZE)
     else:
-        outzip = outfile.with_suffix(".json.gz")
-        with gzip.open(outzip, "w") as zout:
-            zout.write(data)
-    return outzip
\ No newline at end of file
+        for chunk in data:
+            fout.write(chunk)
+
+
+@contextmanager
+def gc_disabled():
+    """Disable the cyclic garbage collector within the context.
+
+    Building a large structure of containers, like a citymodel, triggers many
+    collections that each scan the whole structure, while it does not create
+    garbage. The collector is enabled again afterwards, unless it was disabled
+    already.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def json_dumps(obj, newline: bool = False) -> bytes:
+    """Serialize an object to compact JSON.
+
+    Uses `orjson <https://github.com/ijl/orjson>`_ if it is installed,
+    otherwise falls back to the standard library.
+
+    :param obj: The object to serialize
+    :param newline: Append a newline to the output, eg. for JSON Lines
+    :returns: The UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        option = orjson.OPT_APPEND_NEWLINE if newline else 0
+        return orjson.dumps(obj, option=option)
+    # Like orjson, keep the non-ASCII characters as they are instead of
+    # escaping them, which also spares the escaping pass over the whole string
+    data = json.dumps(obj, separators=(',', ':'),
+                      ensure_ascii=False).encode("utf-8")
+    return data + b"\n" if newline else data
@@ -14,9 +14,14 @@ requirements = [
     'Click>=7.0',
     'psycopg2>=2.8',
     'PyYAML>=5.1.2',
-    'cjio>=0.8.1'
+    'cjio>=0.8.1',
+    'numpy'
 ]
 
+extras_requirements = {
+    'orjson': ['orjson>=3.0'],
+}
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest>=3', ]
@@ -42,6 +47,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + changelog,
     include_package_data=True,
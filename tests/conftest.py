@@ -118,6 +118,33 @@ def db3dnl_db(cfg_db3dnl):
     yield conn
     conn.close()
 
+@pytest.fixture(scope='function')
+def worker_connections(monkeypatch):
+    """Initialize an export worker with fake database connections, and yield
+    the connections that the worker opened"""
+    from cjio_dbexport import db3dnl
+
+    class Connection:
+        readonly = True
+        closed = 0
+        info = type("ConnectionInfo", (), {"transaction_status": 0})
+
+        def close(self):
+            self.closed = 1
+
+    connections = []
+
+    def connect(*args, **kwargs):
+        connections.append(Connection())
+        return connections[-1]
+
+    monkeypatch.setattr(db3dnl.pool.psycopg2, "connect", connect)
+    monkeypatch.setattr(db3dnl, "_worker_db", None)
+    monkeypatch.setattr(db3dnl, "_worker_pool", None)
+    monkeypatch.setattr(db3dnl, "_worker_cfg", None)
+    db3dnl._init_worker({"database": {"dbname": "db3dnl"}})
+    yield connections
+
 @pytest.fixture(scope='function')
 def nl_poly_path(data_dir):
     yield data_dir / 'nl_single.geojson'
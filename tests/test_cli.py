@@ -21,6 +21,23 @@ def test_command_line_interface():
     assert help_result.exit_code == 0
     assert 'Export tool from PostGIS to CityJSON' in help_result.output
 
+
+def test_export_tiles_jsonl_without_features(cfg_db3dnl_path, tmp_path,
+                                             monkeypatch):
+    """--jsonl is rejected without --features, instead of being ignored."""
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    result = runner.invoke(cli.main, [
+        str(cfg_db3dnl_path),
+        'export_tiles',
+        '--jsonl',
+        'gb1',
+        str(tmp_path)
+    ])
+    assert result.exit_code == 2
+    assert '--jsonl can only be used together with --features' in result.output
+
+
 @pytest.mark.db3dnl
 class TestDb3DNLIntegration:
     def test_export_tiles(self, data_output_dir, cfg_db3dnl_path_param, capsys):
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """Testing the 3DNL exporter"""
 
+import datetime
 import logging
 import pickle
 import json
+import struct
 
 import pytest
 
@@ -66,6 +68,339 @@ class TestParsing:
         assert 'Exporting with a list of tiles' in caplog.text
 
 
+@pytest.mark.parametrize('wkt, expect', [
+    ('POLYGON Z ((1 2 3,4 5 6,7 8 9,1 2 3))',
+     [[(4.0, 5.0, 6.0), (7.0, 8.0, 9.0), (1.0, 2.0, 3.0)]]),
+    ('POLYGON Z ((0 0 1,10 0 1,10 10 1,0 0 1),(1 1 1, 2 1 1, 2 2 1, 1 1 1))',
+     [[(10.0, 0.0, 1.0), (10.0, 10.0, 1.0), (0.0, 0.0, 1.0)],
+      [(2.0, 1.0, 1.0), (2.0, 2.0, 1.0), (1.0, 1.0, 1.0)]]),
+    ('POINT Z (1 2 3)', []),
+])
+def test_parse_polygonz(wkt, expect):
+    assert list(db3dnl.parse_polygonz(wkt)) == expect
+
+
+def test_parse_polygonz_numpy():
+    ring = [(float(i), float(i) * 2, 0.5) for i in range(db3dnl.WKT_NUMPY_MIN_POINTS)]
+    ring.append(ring[0])
+    wkt = "POLYGON Z ((" + ",".join(" ".join(map(str, pt)) for pt in ring) + "))"
+    assert list(db3dnl.parse_polygonz(wkt)) == [ring[1:]]
+
+
+def _wkb_polygonz(rings, byteorder='<'):
+    """ISO WKB of a Polygon Z"""
+    wkb = struct.pack('<b', 1 if byteorder == '<' else 0)
+    wkb += struct.pack(byteorder + 'II', 1003, len(rings))
+    for ring in rings:
+        wkb += struct.pack(byteorder + 'I', len(ring))
+        wkb += b''.join(struct.pack(byteorder + 'ddd', *pt) for pt in ring)
+    return wkb
+
+
+def test_parse_wkb_multisurface():
+    ring_1 = [(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 0, 1)]
+    ring_2 = [(5, 5, 5), (6, 5, 5), (6, 6, 5), (5, 5, 5)]
+    wkb = b'\x01' + struct.pack('<II', 1006, 2)
+    wkb += _wkb_polygonz([ring_1]) + _wkb_polygonz([ring_2, ring_1], '>')
+    msurface = db3dnl.parse_wkb_multisurface(wkb)
+    assert msurface == [
+        [[[0.0, 0.0, 1.0], [1.0, 0.0, 1.0], [1.0, 1.0, 1.0]]],
+        [[[5.0, 5.0, 5.0], [6.0, 5.0, 5.0], [6.0, 6.0, 5.0]],
+         [[0.0, 0.0, 1.0], [1.0, 0.0, 1.0], [1.0, 1.0, 1.0]]]
+    ]
+    assert db3dnl.parse_wkb_multisurface(None) is None
+
+
+@pytest.mark.parametrize("values, expected", [
+    (('gb1', 'gb2'), '{"gb1","gb2"}'),
+    ([2, 3], '{"2","3"}'),
+    (['a"b', 'c\\d'], '{"a\\"b","c\\\\d"}'),
+])
+def test_array_literal(values, expected):
+    assert db.array_literal(values).wrapped == expected
+
+
+@pytest.mark.parametrize("tile_list, expected", [
+    (db3dnl.ALL_TILES, True),
+    (["ALL"], True),
+    (["all", "gb1"], False),
+    (["gb1"], False),
+])
+def test_is_all_tiles(tile_list, expected):
+    assert db3dnl.is_all_tiles(tile_list) == expected
+
+
+@pytest.mark.parametrize("nr_surfaces", [6, 100])
+@pytest.mark.parametrize("geomtype", ["Solid", "MultiSurface"])
+def test_record_to_surfaces(geomtype, nr_surfaces):
+    mapping = {0: "GroundSurface", 1: "RoofSurface", 2: "WallSurface",
+               3: "ClosureSurface"}
+    semantics = [(i * 7) % 3 for i in range(nr_surfaces)]
+    msurface = [[[[0.0, 0.0, 0.0]]]] * nr_surfaces
+    boundary = [msurface] if geomtype == "Solid" else msurface
+    surfaces = db3dnl.record_to_surfaces(geomtype=geomtype, boundary=boundary,
+                                         semantics=semantics,
+                                         semantics_mapping=mapping)
+    assert list(surfaces) == [0, 1, 2]
+    for label, srf in surfaces.items():
+        expect = [i for i, sem in enumerate(semantics) if sem == label]
+        if geomtype == "Solid":
+            expect = [[0, i] for i in expect]
+        assert srf == {"surface_idx": expect, "type": mapping[label]}
+
+
+@pytest.mark.parametrize("nr_semantics", [5, 7, 99, 101])
+@pytest.mark.parametrize("nr_surfaces", [6, 100])
+@pytest.mark.parametrize("geomtype", ["Solid", "MultiSurface"])
+def test_record_to_surfaces_unequal(geomtype, nr_surfaces, nr_semantics,
+                                    caplog):
+    """Both the NumPy and the Python grouping assign no semantics when the
+    number of labels and surfaces differ"""
+    mapping = {0: "GroundSurface", 1: "RoofSurface", 2: "WallSurface"}
+    semantics = [i % 3 for i in range(nr_semantics)]
+    msurface = [[[[0.0, 0.0, 0.0]]]] * nr_surfaces
+    boundary = [msurface] if geomtype == "Solid" else msurface
+    surfaces = db3dnl.record_to_surfaces(geomtype=geomtype, boundary=boundary,
+                                         semantics=semantics,
+                                         semantics_mapping=mapping)
+    assert surfaces == {}
+    assert "unequal sized" in caplog.text
+
+
+def test_table_to_cityobjects_attributes():
+    cfg_geom = {'lod': None, 'semantics': None, 'tile_id': 'tile',
+                'semantics_mapping': None}
+    tabledata = [
+        {'pk': 1, 'coid': 'a', 'tile': 'gb1', 'height': None,
+         'built': None, 'name': 'one'},
+        {'pk': 2, 'coid': 'b', 'tile': 'gb1', 'height': 1.123456,
+         'built': datetime.date(2020, 1, 2), 'name': 'two'},
+        {'pk': 3, 'coid': 'c', 'tile': 'gb1', 'height': 2.0,
+         'built': datetime.date(2021, 3, 4), 'name': None},
+    ]
+    cos = dict(db3dnl.table_to_cityobjects(tabledata, cotype='Building',
+                                           cfg_geom=cfg_geom, rounding=2))
+    assert cos['a'].attributes == {'height': None, 'built': None, 'name': 'one'}
+    assert cos['b'].attributes == {'height': 1.12, 'built': '2020-01-02',
+                                   'name': 'two'}
+    assert cos['c'].attributes == {'height': 2.0, 'built': '2021-03-04',
+                                   'name': None}
+
+
+def test_cityjson_metadata():
+    """The transform of the feature metadata matches the compression of the tiles"""
+    metadata = json.loads(db3dnl.CITYJSON_METADATA)
+    scale = 10 ** -db3dnl.IMPORTANT_DIGITS
+    assert metadata["transform"]["scale"] == pytest.approx([scale, scale, scale])
+    assert metadata["transform"]["translate"] == db3dnl.TRANSLATE
+
+
+def test_table_to_cityobjects_attributes_mixed_types():
+    """The values of a json column can have different types in each record"""
+    cfg_geom = {'lod': None, 'semantics': None, 'tile_id': 'tile',
+                'semantics_mapping': None}
+    tabledata = [
+        {'pk': 1, 'coid': 'a', 'tile': 'gb1', 'v': 1.23456},
+        {'pk': 2, 'coid': 'b', 'tile': 'gb1', 'v': 'text'},
+        {'pk': 3, 'coid': 'c', 'tile': 'gb1', 'v': 'x'},
+        {'pk': 4, 'coid': 'd', 'tile': 'gb1', 'v': 6.54321},
+    ]
+    cos = dict(db3dnl.table_to_cityobjects(tabledata, cotype='Building',
+                                           cfg_geom=cfg_geom, rounding=2))
+    assert [cos[coid].attributes['v'] for coid in 'abcd'] == \
+           [1.23, 'text', 'x', 6.54]
+
+
+@pytest.mark.parametrize('attr, expect', [
+    (1.23456, 1.23),
+    (datetime.date(2020, 1, 2), '2020-01-02'),
+    (datetime.datetime(2020, 1, 2, 3, 4, 5), '2020-01-02T03:04:05'),
+    (datetime.time(3, 4, 5), '03:04:05'),
+    (datetime.timedelta(days=1), '1 day, 0:00:00'),
+])
+def test_attribute_converter(attr, expect):
+    convert = db3dnl.attribute_converter(attr, rounding=2)
+    assert convert(attr) == expect
+
+
+@pytest.mark.parametrize('attr', [1, 'one', True, [1, 2]])
+def test_attribute_converter_none(attr):
+    assert db3dnl.attribute_converter(attr, rounding=2) is None
+
+
+@pytest.mark.parametrize('lod_column, expect', [
+    (None, [('geom_lod12', 'MultiSurface', '1.2', 1.2),
+            ('geom_lod22', 'Solid', '2.2', 2.2)]),
+    ('lod', [('geom_lod12', 'MultiSurface', None, None),
+             ('geom_lod22', 'Solid', None, None)]),
+])
+def test_geometry_columns(lod_column, expect):
+    cfg_geom = {'lod12': {'name': 'geom', 'type': 'MultiSurface'},
+                'lod22': {'name': 'geom', 'type': 'Solid'}, 'lod': lod_column,
+                'semantics': None, 'tile_id': None, 'semantics_mapping': None}
+    assert db3dnl.geometry_columns(cfg_geom) == expect
+
+
+def test_table_to_cityobjects_geometry_columns():
+    """Only the aliased geometry columns are excluded from the attributes"""
+    cfg_geom = {'lod12': {'name': 'geom', 'type': 'MultiSurface'}, 'lod': None,
+                'semantics': None, 'tile_id': None, 'semantics_mapping': None}
+    tabledata = [
+        {'pk': 1, 'coid': 'a', 'geom_lod12': None, 'has_geom_lod12': True},
+    ]
+    cos = dict(db3dnl.table_to_cityobjects(tabledata, cotype='Building',
+                                           cfg_geom=cfg_geom, rounding=2))
+    assert cos['a'].attributes == {'has_geom_lod12': True}
+    assert len(cos['a'].geometry) == 1
+
+
+def test_export_in_worker_reuses_connection(worker_connections, monkeypatch):
+    """A worker connects once and keeps the connection for all of its tiles"""
+    conns = []
+
+    def export(tile, filepath, cfg, conn=None, **kwargs):
+        conns.append(conn)
+        return True, filepath
+
+    monkeypatch.setattr(db3dnl, "export", export)
+    for tile in ("gb1", "gb2", "gb3"):
+        db3dnl._export_in_worker(tile, f"/tmp/{tile}.json")
+    assert len(worker_connections) == 1
+    assert conns[0] is conns[1] is conns[2]
+
+
+def test_export_in_worker_keeps_fields(worker_connections, monkeypatch):
+    """The table fields that are cached for a tile are reused for the next tile"""
+    cached = []
+
+    def export(tile, filepath, cfg, conn=None, **kwargs):
+        cached.append(dict(conn._fields))
+        conn._fields.setdefault('"bag"."pand"', ["pk", "coid", "geom"])
+        return True, filepath
+
+    monkeypatch.setattr(db3dnl, "export", export)
+    for tile in ("gb1", "gb2"):
+        db3dnl._export_in_worker(tile, f"/tmp/{tile}.json")
+    assert cached == [{}, {'"bag"."pand"': ["pk", "coid", "geom"]}]
+
+
+@pytest.mark.parametrize("rows, expected", [
+    ([("gb2",), ("gb1",)], ["gb2", "gb1", "gb3"]),
+    (None, ["gb1", "gb2", "gb3"]),
+])
+def test_order_tiles_by_size(cfg_db3dnl, monkeypatch, rows, expected):
+    """The tiles are ordered by the query, the tiles that it does not return
+    are appended, and on an error the given order is kept"""
+    class Conn:
+        conn = None
+
+        def get_query_iter(self, query):
+            if rows is None:
+                raise db3dnl.pgError("function _postgis_selectivity does "
+                                     "not exist")
+            return iter(rows)
+
+    # Quoting an identifier needs a connection
+    monkeypatch.setattr(db3dnl.sql.Identifier, "as_string",
+                        lambda self, context: ".".join(self.strings))
+    ordered = db3dnl.order_tiles_by_size(Conn(), cfg_db3dnl,
+                                         ["gb1", "gb2", "gb3"])
+    assert ordered == expected
+
+
+def test_index_geometry_centroid_one_by_one(cfg_db3dnl):
+    """The indexes that are created one by one, after the single transaction
+    failed, get the same maintenance_work_mem"""
+    class Conn:
+        def __init__(self):
+            self.sent = []
+
+        def print_query(self, query):
+            return ""
+
+        def send_query(self, query):
+            self.sent.append(query)
+            if len(self.sent) == 1:
+                raise db3dnl.pgError("out of memory")
+
+    conn = Conn()
+    assert db3dnl.index_geometry_centroid(conn, cfg_db3dnl)
+    batch, *one_by_one = conn.sent
+    set_work_mem = batch.seq[0]
+    assert len(one_by_one) == len(batch.seq) // 2
+    for query in one_by_one:
+        assert query.seq[0] == set_work_mem
+
+
+def test_export_query_error(monkeypatch, tmp_path, caplog):
+    """An error of the streamed query fails the tile export"""
+    def query(**kwargs):
+        raise db3dnl.ClickException("Could not query pand")
+        yield
+
+    monkeypatch.setattr(db3dnl, "query", query)
+    cfg = {"database": {}, "tile_index": {}, "cityobject_type": {}}
+    filepath = tmp_path / "gb1.json"
+    success, path = db3dnl.export("gb1", filepath, cfg)
+    assert not success
+    assert path == filepath
+    assert "Failed to export tile gb1" in caplog.text
+
+
+@pytest.mark.parametrize('fail_query, fail_putconn', [
+    (True, False),
+    (False, True),
+])
+def test_fetch_to_queue_error(fail_query, fail_putconn):
+    """Every error of a fetching thread is put on the queue for the consumer"""
+    class Pool:
+        def putconn(self, conn, key=None):
+            if fail_putconn:
+                raise db3dnl.pool.PoolError("trying to put unkeyed connection")
+
+    class Conn:
+        conn = None
+
+        def get_dict(self, query):
+            if fail_query:
+                raise TypeError("not a query")
+            return []
+
+    resultsets = db3dnl.queue.Queue()
+    db3dnl._fetch_to_queue(Pool(), Conn(), ("Building", "pand"), None,
+                           resultsets, db3dnl.threading.Semaphore(1),
+                           db3dnl.threading.Event())
+    key, resultset, error = resultsets.get_nowait()
+    assert key == ("Building", "pand")
+    assert resultset is None
+    assert isinstance(error, TypeError if fail_query else db3dnl.pool.PoolError)
+
+
+def test_fetch_to_queue_cancelled():
+    """A fetching thread that waits for a slot gives up when cancelled,
+    without running the query"""
+    returned = []
+
+    class Pool:
+        def putconn(self, conn, key=None):
+            returned.append(key)
+
+    class Conn:
+        conn = None
+
+        def get_dict(self, query):
+            raise AssertionError("the query must not run")
+
+    resultsets = db3dnl.queue.Queue()
+    cancelled = db3dnl.threading.Event()
+    cancelled.set()
+    db3dnl._fetch_to_queue(Pool(), Conn(), ("Building", "pand"), None,
+                           resultsets, db3dnl.threading.Semaphore(0),
+                           cancelled)
+    assert resultsets.empty()
+    assert returned == [("Building", "pand")]
+
+
 # @pytest.mark.db3dnl
 class TestIntegration:
     """Integration tests"""
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 """Testing the utils module"""
+import gc
+import gzip
+import io
 import logging
 import math
 import pytest
@@ -110,4 +113,56 @@ def test_zip_json(data_dir):
         data = fin.read()
     utils.write_zip(data=data.encode("utf-8"),
                     filename="ic3.json",
-                    outdir=Path("/tmp"))
\ No newline at end of file
+                    outdir=Path("/tmp"))
+
+
+def test_zip_fileobj(tmp_path):
+    """Write a zipped json from a file object"""
+    data = b'{"type":"CityJSON"}' * 100000
+    outzip = utils.write_zip(data=io.BytesIO(data), filename="big.json",
+                             outdir=tmp_path)
+    if outzip.suffix == ".gz":
+        with gzip.open(outzip, "rb") as fin:
+            assert fin.read() == data
+
+
+def test_zip_iterable(tmp_path):
+    """Write a zipped json from an iterable of bytes"""
+    lines = [b'{"type":"CityJSONFeature","id":"%d"}\n' % i for i in range(1000)]
+    outzip = utils.write_zip(data=iter(lines), filename="features.city.jsonl",
+                             outdir=tmp_path, suffix=".jsonl")
+    assert outzip.name in ("features.city.jsonl.gz", "features.city.jsonl.zip")
+    if outzip.suffix == ".gz":
+        with gzip.open(outzip, "rb") as fin:
+            assert fin.read() == b"".join(lines)
+
+
+def test_zip_feature_suffix(tmp_path):
+    """A single CityJSONFeature is zipped as .json, whatever its file name"""
+    outzip = utils.write_zip(data=b'{"type":"CityJSONFeature"}',
+                             filename="NL.IMBAG.Pand.1.city.jsonl",
+                             outdir=tmp_path)
+    assert outzip.name in ("NL.IMBAG.Pand.1.city.json.gz",
+                           "NL.IMBAG.Pand.1.city.zip")
+
+
+@pytest.mark.parametrize('newline, expect', [
+    (False, b'{"a":[1,2.5],"b":"c"}'),
+    (True, b'{"a":[1,2.5],"b":"c"}\n'),
+])
+def test_json_dumps(newline, expect):
+    assert utils.json_dumps({"a": [1, 2.5], "b": "c"}, newline=newline) == expect
+
+
+def test_json_dumps_unicode():
+    assert utils.json_dumps({"straat": "Kanaalweg ë"}) == \
+           '{"straat":"Kanaalweg ë"}'.encode("utf-8")
+
+
+def test_gc_disabled():
+    assert gc.isenabled()
+    with pytest.raises(ValueError):
+        with utils.gc_disabled():
+            assert not gc.isenabled()
+            raise ValueError
+    assert gc.isenabled()